@@ -1,7 +1,13 @@
 import asyncio
 import logging
 import json
+import math
+import os
+import re
+import threading
+import time
 from datetime import datetime
+from functools import lru_cache
 
 from maxapi import Bot, Dispatcher
 from maxapi.types import (
@@ -11,16 +17,22 @@ from maxapi.types import (
     CommandStart,
     Command
 )
+from maxapi.types.errors import Error
 from maxapi.utils.inline_keyboard import InlineKeyboardBuilder
 
 from reminders import ReminderManager
+from callback_router import CallbackRouter
+from sessions import SessionStore
 
 
 with open('jsons/FAQ.json', 'r', encoding='utf-8') as f:
     faq_data = json.load(f)
 
-with open('categories.json', 'r', encoding='utf-8') as f:
+CATEGORIES_PATH = 'categories.json'
+
+with open(CATEGORIES_PATH, 'r', encoding='utf-8') as f:
     categories_data = json.load(f)
+categories_mtime = os.path.getmtime(CATEGORIES_PATH)
 
 logging.basicConfig(level=logging.INFO)
 
@@ -30,7 +42,9 @@ dp = Dispatcher()
 
 reminder_manager = ReminderManager(bot)
 
-user_modes = {}
+# Режимы чатов с TTL в памяти процесса. SESSION_DB=<файл> включает SQLite,
+# чтобы режимы переживали перезапуск и были общими для нескольких процессов бота
+user_modes = SessionStore(os.environ.get("SESSION_DB") or None)
 
 
 def normalize_string(s):
@@ -44,13 +58,18 @@ for question, answer in faq_data.items():
     normalized_faq_data[normalized_question] = answer
 
 
-normalized_categories_data = {}
-for category, data in categories_data.items():
-    normalized_questions = [normalize_string(q) for q in data.get("questions", [])]
-    normalized_categories_data[category] = {
-        "title": data.get("title", ""),
-        "questions": normalized_questions
-    }
+def normalize_categories(categories):
+    normalized = {}
+    for category, data in categories.items():
+        normalized_questions = [normalize_string(q) for q in data.get("questions", [])]
+        normalized[category] = {
+            "title": data.get("title", ""),
+            "questions": normalized_questions
+        }
+    return normalized
+
+
+normalized_categories_data = normalize_categories(categories_data)
 
 
 def get_questions_for_category(category):
@@ -69,23 +88,61 @@ def get_original_questions_for_category(category):
 # Инициализация ИИ
 #============================================================================
 from scripts.model_init import get_embedder
-from scripts.rag import init_bot, init_bot2, qa_ai, qa_ai_nav, PROMPT1, PROMPT2
+from scripts.rag import init_bot, init_bot2, qa_ai, qa_ai_stream, qa_ai_nav, warm_up_llm, PROMPT1, PROMPT2, AsyncInference
 
 embedder = get_embedder()
 DEFAULT_OUT = "kb_output"
 qa_chain = init_bot(embedder, DEFAULT_OUT, prompt=PROMPT1)
 qa_chain_map = init_bot2(prompt=PROMPT2)
 
+# Повторяющиеся свободные вопросы отвечаются из кэша без обращения к LLM
+from scripts.answer_cache import AnswerCache
+answer_cache = AnswerCache(embedder, DEFAULT_OUT)
+
+# Генерации выполняются вне event loop, чтобы бот отвечал на кнопки во время работы LLM
+llm_pool = AsyncInference()
+
+# Пересобранный индекс подхватывается без перезапуска бота. Файл должен не меняться
+# INDEX_SETTLE_SECONDS: save_local пишет index.faiss и index.pkl не одновременно
+INDEX_SETTLE_SECONDS = 5
+qa_chain_reload_lock = asyncio.Lock()
+
+
+async def reload_qa_chain_if_changed():
+    """
+    Перезагружает qa_chain, если FAISS-индекс на диске пересобран, и только после
+    этого очищает кэш ответов, чтобы он не заполнился ответами по старому индексу.
+    """
+    global qa_chain
+
+    mtime = answer_cache.get_index_mtime()
+    if mtime is None or mtime == answer_cache.index_mtime or time.time() - mtime < INDEX_SETTLE_SECONDS:
+        return
+    async with qa_chain_reload_lock:
+        if mtime == answer_cache.index_mtime:
+            return
+        logging.info("FAISS-индекс изменился, загружаем его заново")
+        new_chain = await asyncio.to_thread(init_bot, embedder, DEFAULT_OUT, prompt=PROMPT1)
+        if new_chain is None:
+            # Остаёмся на старой цепочке и её кэше до следующей пересборки
+            logging.error("Не удалось загрузить пересобранный FAISS-индекс, отвечаем по старому")
+            answer_cache.index_mtime = mtime
+            return
+        qa_chain = new_chain
+        answer_cache.reset(mtime)
+
+
+from navigation import NavigationImageIndex
+
+# Индекс картинок img/<здание>/<аудитория>_N.jpg строится при старте
+navigation_images = NavigationImageIndex()
+navigation_images.rebuild()
+
 
-import re
-import logging
-import urllib.parse
-import urllib.request
-from urllib.error import HTTPError, URLError
 async def find_navigation_images(answer: str) -> list[str]:
     """
     Извлекает путь к зданию и номер аудитории из ответа,
-    возвращает список GitHub URLs к изображениям, которые существуют.
+    возвращает список GitHub URLs к изображениям, которые есть в папке img/.
     """
     logging.info("зашли в find_navigation_images")
     
@@ -105,38 +162,7 @@ async def find_navigation_images(answer: str) -> list[str]:
 
     room = rm.group(1)
     
-    # Базовый URL вашего GitHub репозитория
-    base_url = "https://raw.githubusercontent.com/oleffr/vk_hackaton_bot/main/img"
-    
-    # Правильно кодируем кириллицу в URL
-    building_encoded = urllib.parse.quote(building)
-    
-    # Формируем возможные URL с кодированием
-    possible_urls = [
-        f"{base_url}/{building_encoded}/{room}_1.jpg",
-        f"{base_url}/{building_encoded}/{room}_2.jpg", 
-    ]
-    
-    # Убираем возможные двойные слеши
-    clean_urls = [url.replace('//', '/').replace(':/', '://') for url in possible_urls]
-    
-    # Проверяем существование файлов
-    existing_urls = []
-    for url in clean_urls:
-        try:
-            # Создаем запрос и проверяем статус
-            req = urllib.request.Request(url, method='HEAD')
-            response = urllib.request.urlopen(req)
-            if response.status == 200:
-                existing_urls.append(url)
-                logging.info(f"Файл существует: {url}")
-        except (HTTPError, URLError) as e:
-            logging.info(f"Файл не существует: {url} - {e}")
-            continue
-        except Exception as e:
-            logging.warning(f"Ошибка при проверке {url}: {e}")
-            continue
-    
+    existing_urls = navigation_images.lookup(building, room)
     logging.info(f"Найдено существующих файлов: {len(existing_urls)}")
     return existing_urls
 
@@ -149,6 +175,10 @@ async def send_navigation_response(event, answer: str):
     
    
     image_urls = await find_navigation_images(answer)
+    await send_navigation_images(event, image_urls)
+
+
+async def send_navigation_images(event, image_urls: list[str]):
 
     if not image_urls:
         await event.message.answer("❌ Сейчас данное место не поддерживается ботом или его не существует")
@@ -165,6 +195,10 @@ async def send_navigation_response(event, answer: str):
 # ОБНОВЛЕННЫЕ ФУНКЦИИ МЕНЮ
 # ============================================================================
 
+# Статические клавиатуры не меняются, поэтому строятся один раз и переиспользуются.
+# Клавиатуры FAQ собираются из categories.json в build_faq_menus().
+
+@lru_cache(maxsize=None)
 def get_main_menu():
     builder = InlineKeyboardBuilder()
     
@@ -178,22 +212,22 @@ def get_main_menu():
     return builder.as_markup()
 
 
-def get_faq_categories_menu():
+def build_faq_categories_menu():
     builder = InlineKeyboardBuilder()
     
   
-    builder.row(CallbackButton(text="🌱 Адаптация первокурсников", payload="menu_freshmen"))
-    builder.row(CallbackButton(text="📚 Учебный процесс", payload="menu_studies"))
-    builder.row(CallbackButton(text="📄 Документы и справки", payload="menu_documents"))
-    builder.row(CallbackButton(text="🎉 Студенческая жизнь", payload="menu_campus_life"))
-    builder.row(CallbackButton(text="🔧 Техническая поддержка", payload="menu_support"))
-    builder.row(CallbackButton(text="💳 Финансовые вопросы", payload="menu_finance"))
-    builder.row(CallbackButton(text="🔬 Наука и исследования", payload="menu_research"))
+    for category, data in categories_data.items():
+        builder.row(CallbackButton(text=data.get("title", "Категория"), payload=category))
     builder.row(CallbackButton(text="🔙 Назад в главное меню", payload="back_to_main"))
     
     return builder.as_markup()
 
 
+def get_faq_categories_menu():
+    return faq_categories_menu
+
+
+@lru_cache(maxsize=None)
 def get_reminders_menu():
     builder = InlineKeyboardBuilder()
     builder.row(CallbackButton(text="➕ Добавить напоминание", payload="add_reminder"))
@@ -203,15 +237,14 @@ def get_reminders_menu():
     return builder.as_markup()
 
 
-def get_questions_menu(category):
+def build_questions_menu(category):
     builder = InlineKeyboardBuilder()
     
    
     original_questions = get_original_questions_for_category(category)
+    category_simple = category.replace("menu_", "")
     
-    for question in original_questions:
-        category_simple = category.replace("menu_", "")
-        question_index = original_questions.index(question)
+    for question_index, question in enumerate(original_questions):
         question_id = f"q_{category_simple}_{question_index}"
         builder.row(CallbackButton(text=question, payload=question_id))
     
@@ -220,6 +253,13 @@ def get_questions_menu(category):
     return builder.as_markup()
 
 
+def get_questions_menu(category):
+    menu = questions_menus.get(category)
+    if menu is None:
+        menu = build_questions_menu(category)
+    return menu
+
+
 def get_week_reminders_menu(reminders):
     builder = InlineKeyboardBuilder()
     
@@ -246,47 +286,156 @@ def get_date_reminders_menu(reminders, target_date):
     return builder.as_markup()
 
 
+def tokenize(s):
+    return frozenset(re.findall(r'\w+', s.lower()))
+
+
+def build_faq_index(faq):
+    """
+    Слова каждого вопроса FAQ, обратный индекс слово -> вопросы и индекс по самому
+    редкому слову вопроса: вопрос FAQ, целиком входящий в запрос, находится по нему
+    """
+    tokens_by_question = {faq_question: tokenize(faq_question) for faq_question in faq}
+    token_index = {}
+    for faq_question, tokens in tokens_by_question.items():
+        for token in tokens:
+            token_index.setdefault(token, []).append(faq_question)
+    rare_index = {}
+    for faq_question, tokens in tokens_by_question.items():
+        if tokens:
+            rarest = min(tokens, key=lambda t: (len(token_index[t]), t))
+            rare_index.setdefault(rarest, []).append(faq_question)
+    return tokens_by_question, token_index, rare_index
+
+
+# Индекс FAQ строится один раз при старте
+faq_tokens, faq_token_index, faq_rare_index = build_faq_index(normalized_faq_data)
+
+FAQ_MIN_SIMILARITY = 0.6
+
+
 def get_answer(question):
 
     
     normalized_question = normalize_string(question)
     
-    logging.info(f"Поиск ответа для: '{question}' -> нормализовано: '{normalized_question}'")
-    
-    if normalized_question in normalized_faq_data:
-        logging.info(f"Найден прямой ответ для: '{normalized_question}'")
-        return normalized_faq_data[normalized_question]
-    
-  
-    for faq_question, answer in normalized_faq_data.items():
-        if normalized_question == faq_question:
-            logging.info(f"Найден ответ при дополнительном поиске: '{faq_question}'")
-            return answer
-    
-
-    for faq_question, answer in normalized_faq_data.items():
-        if normalized_question in faq_question or faq_question in normalized_question:
-            logging.info(f"Найден ответ при частичном совпадении: '{faq_question}'")
-            return answer
+    answer = normalized_faq_data.get(normalized_question)
+    if answer is not None:
+        return answer
+
+    logging.info(f"Нет прямого ответа для: '{question}' -> нормализовано: '{normalized_question}'")
+
+    tokens = tokenize(normalized_question)
+    # Слова запроса, известные FAQ, от редких к частым
+    known = sorted((t for t in tokens if t in faq_token_index), key=lambda t: len(faq_token_index[t]))
+
+    # Частичное совпадение: запрос внутри вопроса FAQ (такой вопрос содержит все слова запроса)
+    # или вопрос FAQ внутри запроса (его самое редкое слово есть в запросе)
+    partial = set()
+    if known:
+        containing = set(faq_token_index[known[0]])
+        for token in known[1:]:
+            containing.intersection_update(faq_token_index[token])
+        partial.update(q for q in containing if normalized_question in q)
+    for token in tokens:
+        partial.update(q for q in faq_rare_index.get(token, ()) if q in normalized_question)
+    if partial:
+        faq_question = min(partial, key=lambda q: (-len(tokens & faq_tokens[q]), q))
+        logging.info(f"Найден ответ при частичном совпадении: '{faq_question}'")
+        return normalized_faq_data[faq_question]
+
+    # Совпадение слов: вопрос с близостью не ниже FAQ_MIN_SIMILARITY содержит хотя бы одно
+    # из первых prefix редких слов запроса и по числу слов не сильно отличается от него,
+    # так что частые слова ("как", "в") не тянут за собой половину FAQ
+    required = math.ceil(FAQ_MIN_SIMILARITY * len(tokens) - 1e-9)
+    prefix = len(known) - required + 1
+    best_question, best_similarity = None, 0.0
+    for token in known[:max(prefix, 0)]:
+        for faq_question in faq_token_index[token]:
+            faq_question_tokens = faq_tokens[faq_question]
+            if not required <= len(faq_question_tokens) <= len(tokens) / FAQ_MIN_SIMILARITY:
+                continue
+            similarity = len(tokens & faq_question_tokens) / len(tokens | faq_question_tokens)
+            if similarity > best_similarity:
+                best_question, best_similarity = faq_question, similarity
+
+    if best_similarity >= FAQ_MIN_SIMILARITY:
+        logging.info(f"Найден ответ по совпадению слов: '{best_question}'")
+        return normalized_faq_data[best_question]
     
     logging.warning(f"Ответ не найден для: '{normalized_question}'")
-    available_keys = list(normalized_faq_data.keys())
-    if available_keys:
-        logging.warning(f"Доступные ключи в FAQ (первые 5): {available_keys[:5]}")
-    
     return "Ответ на данный вопрос временно недоступен."
 
 
+def build_faq_menus():
+    """Собирает клавиатуры FAQ и ответы на кнопки вопросов из categories.json"""
+    global faq_answers_by_id, questions_menus, faq_categories_menu
+
+    # id кнопки -> (категория, вопрос как в categories.json, ответ)
+    answers_by_id = {}
+    for category, data in normalized_categories_data.items():
+        category_simple = category.replace("menu_", "")
+        original_questions = get_original_questions_for_category(category)
+        for question_index, normalized_question in enumerate(data["questions"]):
+            original_question = original_questions[question_index] if question_index < len(original_questions) else normalized_question
+            answers_by_id[f"q_{category_simple}_{question_index}"] = (
+                category, original_question, get_answer(normalized_question)
+            )
+
+    faq_answers_by_id = answers_by_id
+    questions_menus = {category: build_questions_menu(category) for category in categories_data}
+    faq_categories_menu = build_faq_categories_menu()
+
+
+def reload_categories_if_changed():
+    """Перечитывает categories.json и пересобирает клавиатуры FAQ, если файл изменился"""
+    global categories_data, normalized_categories_data, categories_mtime
+
+    try:
+        mtime = os.path.getmtime(CATEGORIES_PATH)
+        if mtime == categories_mtime:
+            return
+        with open(CATEGORIES_PATH, 'r', encoding='utf-8') as f:
+            new_categories = json.load(f)
+    except (OSError, ValueError) as e:
+        logging.error(f"Не удалось перечитать {CATEGORIES_PATH}: {e}")
+        return
+
+    categories_data = new_categories
+    normalized_categories_data = normalize_categories(categories_data)
+    categories_mtime = mtime
+    build_faq_menus()
+    logging.info(f"{CATEGORIES_PATH} изменился, клавиатуры FAQ пересобраны")
+
+
+build_faq_menus()
+
+
 # ============================================================================
 # ОБРАБОТЧИКИ КОМАНД
 # ============================================================================
 
 
+async def set_user_mode(message, chat_id, mode) -> bool:
+    """
+    Сохраняет режим чата. Если запись не удалась, сообщает об этом пользователю:
+    иначе следующее сообщение молча уйдёт не в тот режим.
+    """
+    if await user_modes.set(chat_id, mode):
+        return True
+    await message.answer(
+        "⚠️ Не удалось переключить режим, попробуйте ещё раз.",
+        attachments=[get_main_menu()]
+    )
+    return False
+
+
 @dp.message_created(CommandStart())
 async def send_welcome(event: MessageCreated):
     # Сбрасываем режим пользователя при старте
     chat_id = event.message.recipient.chat_id
-    user_modes[chat_id] = None
+    if not await set_user_mode(event.message, chat_id, None):
+        return
     
     welcome_text = (
         "👋 Добро пожаловать в студенческий помощник Политеха!\n\n"
@@ -300,7 +449,8 @@ async def send_welcome(event: MessageCreated):
 async def show_menu(event: MessageCreated):
     # Сбрасываем режим пользователя при возврате в меню
     chat_id = event.message.recipient.chat_id
-    user_modes[chat_id] = None
+    if not await set_user_mode(event.message, chat_id, None):
+        return
     
     await event.message.answer("Главное меню:", attachments=[get_main_menu()])
 
@@ -308,16 +458,18 @@ async def show_menu(event: MessageCreated):
 @dp.message_created(Command('cancel'))
 async def cancel_mode(event: MessageCreated):
     chat_id = event.message.recipient.chat_id
-    current_mode = user_modes.get(chat_id)
+    current_mode = await user_modes.get(chat_id)
     
     if current_mode == 'free_question':
-        user_modes[chat_id] = None
+        if not await set_user_mode(event.message, chat_id, None):
+            return
         await event.message.answer(
             "✅ Вы вышли из режима свободного вопроса.",
             attachments=[get_main_menu()]
         )
     elif current_mode == 'navigation':
-        user_modes[chat_id] = None
+        if not await set_user_mode(event.message, chat_id, None):
+            return
         await event.message.answer(
             "✅ Вы вышли из режима навигации.",
             attachments=[get_main_menu()]
@@ -333,7 +485,8 @@ async def cancel_mode(event: MessageCreated):
 async def set_reminder_command(event: MessageCreated):
    
     chat_id = event.message.recipient.chat_id
-    user_modes[chat_id] = None
+    if not await set_user_mode(event.message, chat_id, None):
+        return
     
     try:
         parts = event.message.body.text.split(' ', 2)
@@ -388,245 +541,221 @@ async def set_reminder_command(event: MessageCreated):
 #  ОБРАБОТЧИК КНОПОК
 # ============================================================================
 
+callback_router = CallbackRouter()
+
+
 @dp.message_callback()
 async def handle_button_click(callback: MessageCallback):
-    if hasattr(callback, 'callback') and hasattr(callback.callback, 'payload'):
-        payload = callback.callback.payload
-    else:
-        try:
-            callback_data = callback.model_dump()
-            payload = callback_data.get('callback', {}).get('payload')
-        except:
-            payload = None
+    payload = getattr(getattr(callback, 'callback', None), 'payload', None)
     
     if not payload:
         await callback.message.answer("Ошибка обработки запроса.", attachments=[get_main_menu()])
         return
 
     print("Extracted payload:", payload)
+    reload_categories_if_changed()
     
  
     chat_id = callback.message.recipient.chat_id
-    
-   
-    if payload == "back_to_main":
-        user_modes[chat_id] = None  
-        await callback.message.answer("Главное меню:", attachments=[get_main_menu()])
-        return
-    
-    
-    if payload == "back_to_faq_categories":
-        user_modes[chat_id] = None  
-        await callback.message.answer("❓ Часто задаваемые вопросы:", attachments=[get_faq_categories_menu()])
-        return
-    
-  
-    if payload == "back_to_reminders":
-        user_modes[chat_id] = None 
-        await callback.message.answer("📅 Управление напоминаниями:", attachments=[get_reminders_menu()])
+    # Режим сбрасывается при любой кнопке, кроме входа в свободный вопрос и навигацию
+    if not await set_user_mode(callback.message, chat_id, None):
         return
     
+    await callback_router.dispatch(callback, payload, chat_id)
 
-    if payload == "reminders_menu":
-        user_modes[chat_id] = None  
-        await callback.message.answer("📅 Управление напоминаниями:", attachments=[get_reminders_menu()])
-        return
-    
 
-    if payload == "faq_categories":
-        user_modes[chat_id] = None  
-        await callback.message.answer(
-            "❓ Выберите категорию часто задаваемых вопросов:",
-            attachments=[get_faq_categories_menu()]
-        )
-        return
-    
+@callback_router.exact("back_to_main")
+async def on_back_to_main(callback, payload, chat_id):
+    await callback.message.answer("Главное меню:", attachments=[get_main_menu()])
 
-    if payload == "free_question":
-        user_modes[chat_id] = 'free_question'
-        await callback.message.answer(
-            "⏳ Подождите, пока система обработает запрос...\n\n"
-            "✅ Система готова! Задайте ваш вопрос.\n\n"
-            "💡 *Режим свободного вопроса активирован*\n"
-            "Для выхода используйте команду /cancel",
-            attachments=None
-        )
-        return
-    
 
-    if payload == "navigation":
-        user_modes[chat_id] = 'navigation'
-        await callback.message.answer(
-            "⏳ Подождите, пока система обработает запрос...\n\n"
-            "✅ Система готова! Введите ваш навигационный запрос.\n\n"
-            "🗺️ *Режим навигации активирован*\n"
-            "Для выхода используйте команду /cancel",
-            attachments=None
-        )
+@callback_router.exact("back_to_faq_categories")
+async def on_back_to_faq_categories(callback, payload, chat_id):
+    await callback.message.answer("❓ Часто задаваемые вопросы:", attachments=[get_faq_categories_menu()])
+
+
+@callback_router.exact("back_to_reminders", "reminders_menu")
+async def on_reminders_menu(callback, payload, chat_id):
+    await callback.message.answer("📅 Управление напоминаниями:", attachments=[get_reminders_menu()])
+
+
+@callback_router.exact("faq_categories")
+async def on_faq_categories(callback, payload, chat_id):
+    await callback.message.answer(
+        "❓ Выберите категорию часто задаваемых вопросов:",
+        attachments=[get_faq_categories_menu()]
+    )
+
+
+@callback_router.exact("free_question")
+async def on_free_question(callback, payload, chat_id):
+    if not await set_user_mode(callback.message, chat_id, 'free_question'):
         return
-    
+    await callback.message.answer(
+        "⏳ Подождите, пока система обработает запрос...\n\n"
+        "✅ Система готова! Задайте ваш вопрос.\n\n"
+        "💡 *Режим свободного вопроса активирован*\n"
+        "Для выхода используйте команду /cancel",
+        attachments=None
+    )
 
-    if payload == "bot_help":
-        user_modes[chat_id] = None
-        await callback.message.answer(
-            "ℹ️ Помощь по боту:\n\n"
-            "📅 **Напоминания** - устанавливайте напоминания о важных событиях\n"
-            "❓ **Часто задаваемые вопросы** - ответы на популярные вопросы студентов\n"
-            "💬 **Свободный вопрос** - задайте любой вопрос (режим эхо-ответа)\n"
-            "🗺️ **Навигация** - найдите нужное место в университете (режим эхо-ответа)\n\n"
-            "Команды:\n"
-            "/menu - главное меню\n"
-            "/cancel - выход из режимов\n"
-            "/remind ДД.ММ.ГГГГ текст - установить напоминание\n"
-            "/edit_text ID новый_текст - изменить текст напоминания",
-            attachments=[get_main_menu()]
-        )
+
+@callback_router.exact("navigation")
+async def on_navigation(callback, payload, chat_id):
+    if not await set_user_mode(callback.message, chat_id, 'navigation'):
         return
+    await callback.message.answer(
+        "⏳ Подождите, пока система обработает запрос...\n\n"
+        "✅ Система готова! Введите ваш навигационный запрос.\n\n"
+        "🗺️ *Режим навигации активирован*\n"
+        "Для выхода используйте команду /cancel",
+        attachments=None
+    )
+
+
+@callback_router.exact("bot_help")
+async def on_bot_help(callback, payload, chat_id):
+    await callback.message.answer(
+        "ℹ️ Помощь по боту:\n\n"
+        "📅 **Напоминания** - устанавливайте напоминания о важных событиях\n"
+        "❓ **Часто задаваемые вопросы** - ответы на популярные вопросы студентов\n"
+        "💬 **Свободный вопрос** - задайте любой вопрос (режим эхо-ответа)\n"
+        "🗺️ **Навигация** - найдите нужное место в университете (режим эхо-ответа)\n\n"
+        "Команды:\n"
+        "/menu - главное меню\n"
+        "/cancel - выход из режимов\n"
+        "/remind ДД.ММ.ГГГГ текст - установить напоминание\n"
+        "/edit_text ID новый_текст - изменить текст напоминания",
+        attachments=[get_main_menu()]
+    )
+
+
+@callback_router.exact("add_reminder")
+async def on_add_reminder(callback, payload, chat_id):
+    await callback.message.answer(
+        "Чтобы установить напоминание, отправьте команду:\n"
+        "/remind ДД.ММ.ГГГГ текст напоминания\n\n"
+        "Например:\n"
+        "/remind 25.12.2024 Новогодний ужин",
+        attachments=[get_reminders_menu()]
+    )
+
+
+@callback_router.exact("week_reminders")
+async def on_week_reminders(callback, payload, chat_id):
+    reminders = await reminder_manager.get_week_reminders(chat_id)
     
-    
-    if payload == "add_reminder":
-        user_modes[chat_id] = None
+    if not reminders:
         await callback.message.answer(
-            "Чтобы установить напоминание, отправьте команду:\n"
-            "/remind ДД.ММ.ГГГГ текст напоминания\n\n"
-            "Например:\n"
-            "/remind 25.12.2024 Новогодний ужин",
+            "На эту неделю у вас нет напоминаний.",
             attachments=[get_reminders_menu()]
         )
         return
+    
+    message = "📅 Ваши напоминания на эту неделю:\n\n"
+    for reminder_id, text, date_str in reminders:
+        date = datetime.strptime(date_str, '%Y-%m-%d').date()
+        message += f"• ID {reminder_id}: {date.strftime('%d.%m.%Y')} - {text}\n"
+    
+    message += "\nДля редактирования используйте команду: /edit_text [ID] [новый_текст]"
+    
+    await callback.message.answer(
+        message,
+        attachments=[get_week_reminders_menu(reminders)]
+    )
+
+
+@callback_router.exact("edit_by_date")
+async def on_edit_by_date(callback, payload, chat_id):
+    await callback.message.answer(
+        "Введите дату в формате ДД.ММ.ГГГГ для просмотра напоминаний:\n"
+        "Например: 25.12.2024",
+        attachments=[get_reminders_menu()]
+    )
+
 
-    if payload == "week_reminders":
-        user_modes[chat_id] = None
-        reminders = await reminder_manager.get_week_reminders(chat_id)
+@callback_router.prefix("edit_text_")
+async def on_edit_text(callback, payload, chat_id):
+    try:
+        reminder_id = int(payload.split("_")[2])
+        # Получаем информацию о напоминании
+        reminders = await reminder_manager.get_user_reminders(chat_id)
+        target_reminder = None
+        for rem_id, text, date_str in reminders:
+            if rem_id == reminder_id:
+                target_reminder = (rem_id, text, date_str)
+                break
         
-        if not reminders:
+        if target_reminder:
+            rem_id, text, date_str = target_reminder
+            date = datetime.strptime(date_str, '%Y-%m-%d').date()
             await callback.message.answer(
-                "На эту неделю у вас нет напоминаний.",
+                f"✏️ Редактирование напоминания (ID: {reminder_id}):\n\n"
+                f"Текущий текст: {text}\n"
+                f"Дата: {date.strftime('%d.%m.%Y')}\n\n"
+                f"Для изменения текста отправьте:\n"
+                f"/edit_text {reminder_id} новый_текст\n\n"
+                f"Например:\n"
+                f"/edit_text {reminder_id} Встреча с деканом в 15:00",
                 attachments=[get_reminders_menu()]
             )
-            return
-        
-        message = "📅 Ваши напоминания на эту неделю:\n\n"
-        for reminder_id, text, date_str in reminders:
-            date = datetime.strptime(date_str, '%Y-%m-%d').date()
-            message += f"• ID {reminder_id}: {date.strftime('%d.%m.%Y')} - {text}\n"
-        
-        message += "\nДля редактирования используйте команду: /edit_text [ID] [новый_текст]"
-        
-        await callback.message.answer(
-            message,
-            attachments=[get_week_reminders_menu(reminders)]
-        )
-        return
-  
-    if payload == "edit_by_date":
-        user_modes[chat_id] = None
+        else:
+            await callback.message.answer(
+                "Напоминание не найдено.",
+                attachments=[get_reminders_menu()]
+            )
+    except Exception as e:
         await callback.message.answer(
-            "Введите дату в формате ДД.ММ.ГГГГ для просмотра напоминаний:\n"
-            "Например: 25.12.2024",
+            "Ошибка при редактировании напоминания.",
             attachments=[get_reminders_menu()]
         )
-        return
-    
 
-    if payload.startswith("edit_text_"):
-        user_modes[chat_id] = None
-        try:
-            reminder_id = int(payload.split("_")[2])
-            # Получаем информацию о напоминании
-            reminders = await reminder_manager.get_user_reminders(chat_id)
-            target_reminder = None
-            for rem_id, text, date_str in reminders:
-                if rem_id == reminder_id:
-                    target_reminder = (rem_id, text, date_str)
-                    break
-            
-            if target_reminder:
-                rem_id, text, date_str = target_reminder
-                date = datetime.strptime(date_str, '%Y-%m-%d').date()
-                await callback.message.answer(
-                    f"✏️ Редактирование напоминания (ID: {reminder_id}):\n\n"
-                    f"Текущий текст: {text}\n"
-                    f"Дата: {date.strftime('%d.%m.%Y')}\n\n"
-                    f"Для изменения текста отправьте:\n"
-                    f"/edit_text {reminder_id} новый_текст\n\n"
-                    f"Например:\n"
-                    f"/edit_text {reminder_id} Встреча с деканом в 15:00",
-                    attachments=[get_reminders_menu()]
-                )
-            else:
-                await callback.message.answer(
-                    "Напоминание не найдено.",
-                    attachments=[get_reminders_menu()]
-                )
-        except Exception as e:
+
+@callback_router.prefix("delete_")
+async def on_delete_reminder(callback, payload, chat_id):
+    try:
+        reminder_id = int(payload.split("_")[1])
+        success = await reminder_manager.delete_reminder(reminder_id, chat_id)
+        if success:
             await callback.message.answer(
-                "Ошибка при редактировании напоминания.",
+                f"✅ Напоминание (ID: {reminder_id}) удалено!",
                 attachments=[get_reminders_menu()]
             )
-        return
-    
-
-    if payload.startswith("delete_"):
-        user_modes[chat_id] = None
-        try:
-            reminder_id = int(payload.split("_")[1])
-            success = await reminder_manager.delete_reminder(reminder_id, chat_id)
-            if success:
-                await callback.message.answer(
-                    f"✅ Напоминание (ID: {reminder_id}) удалено!",
-                    attachments=[get_reminders_menu()]
-                )
-            else:
-                await callback.message.answer(
-                    f"❌ Не удалось удалить напоминание (ID: {reminder_id})",
-                    attachments=[get_reminders_menu()]
-                )
-        except Exception as e:
+        else:
             await callback.message.answer(
-                "❌ Ошибка при удалении напоминания",
+                f"❌ Не удалось удалить напоминание (ID: {reminder_id})",
                 attachments=[get_reminders_menu()]
             )
+    except Exception as e:
+        await callback.message.answer(
+            "❌ Ошибка при удалении напоминания",
+            attachments=[get_reminders_menu()]
+        )
+
+
+@callback_router.prefix("q_")
+async def on_faq_question(callback, payload, chat_id):
+    faq_entry = faq_answers_by_id.get(payload)
+    if faq_entry:
+        category, original_question, answer = faq_entry
+        await callback.message.answer(
+            f"**{original_question}**\n\n{answer}",
+            attachments=[get_questions_menu(category)]
+        )
         return
-    
-    if payload.startswith("q_"):
-        user_modes[chat_id] = None
-        parts = payload.split("_")
-        if len(parts) >= 3:
-            category_simple = parts[1]
-            category = f"menu_{category_simple}"
-            
-            try:
-                question_index = int(parts[2])
-               
-                normalized_questions = get_questions_for_category(category)
-                
-                original_questions = get_original_questions_for_category(category)
-                
-                if 0 <= question_index < len(normalized_questions):
-                    normalized_question = normalized_questions[question_index]
-                    original_question = original_questions[question_index] if question_index < len(original_questions) else normalized_question
-                    
-                    answer = get_answer(normalized_question)
-                    await callback.message.answer(
-                        f"**{original_question}**\n\n{answer}",
-                        attachments=[get_questions_menu(category)]
-                    )
-                    return
-            except (ValueError, IndexError) as e:
-                logging.error(f"Ошибка обработки вопроса: {e}")
-                pass
-    
-   
+    logging.error(f"Неизвестный вопрос FAQ: {payload}")
+    await on_category(callback, payload, chat_id)
+
+
+@callback_router.default
+async def on_category(callback, payload, chat_id):
     if payload in categories_data:
-        user_modes[chat_id] = None
         category_title = get_category_title(payload)
         await callback.message.answer(
             f"{category_title}\n\nВыберите интересующий вас вопрос:",
             attachments=[get_questions_menu(payload)]
         )
     else:
-        user_modes[chat_id] = None
         await callback.message.answer(
             "Извините, раздел временно недоступен.",
             attachments=[get_main_menu()]
@@ -641,7 +770,8 @@ async def handle_button_click(callback: MessageCallback):
 async def edit_text_reminder_command(event: MessageCreated):
    
     chat_id = event.message.recipient.chat_id
-    user_modes[chat_id] = None
+    if not await set_user_mode(event.message, chat_id, None):
+        return
     
     try:
         parts = event.message.body.text.split(' ', 2)
@@ -713,6 +843,56 @@ async def edit_text_reminder_command(event: MessageCreated):
         logging.error(f"Ошибка редактирования текста напоминания: {e}")
 
 
+# Потоковый вывод: сообщение "Подождите" правится по мере генерации ответа
+STREAM_ANSWERS = os.environ.get("STREAM_ANSWERS", "1") != "0"
+STREAM_EDIT_INTERVAL = 1.0  # не чаще одного редактирования сообщения в секунду
+
+
+async def edit_message_text(message_id, text) -> bool:
+    if message_id is None:
+        return False
+    try:
+        result = await bot.edit_message(message_id=message_id, text=text)
+        if isinstance(result, Error):
+            logging.warning(f"Не удалось отредактировать сообщение {message_id}: {result}")
+            return False
+        return True
+    except Exception as e:
+        logging.warning(f"Не удалось отредактировать сообщение {message_id}: {e}")
+        return False
+
+
+async def generate_free_answer(text, status_mid):
+    """Ответ на свободный вопрос: кэш, затем LLM с потоковым выводом в status_mid"""
+    await reload_qa_chain_if_changed()
+    cached = answer_cache.get(text)
+    if cached is not None:
+        return cached
+
+    if not STREAM_ANSWERS or status_mid is None:
+        return await llm_pool.run(answer_cache.get_or_compute, text, lambda: qa_ai(qa_chain, text))
+
+    progress = {"text": ""}
+    cancelled = threading.Event()
+
+    def compute():
+        return qa_ai_stream(qa_chain, text, lambda t: progress.__setitem__("text", t), cancelled.is_set)
+
+    task = asyncio.ensure_future(llm_pool.run(answer_cache.get_or_compute, text, compute))
+    shown = ""
+    try:
+        while not task.done():
+            await asyncio.wait({task}, timeout=STREAM_EDIT_INTERVAL)
+            current = progress["text"]
+            if not task.done() and current and current != shown:
+                shown = current
+                await edit_message_text(status_mid, f"✍️ {current}…")
+        return task.result()
+    finally:
+        # При таймауте или ошибке генерация в потоке прекращается на следующем фрагменте
+        cancelled.set()
+
+
 @dp.message_created()
 async def handle_date_input(event: MessageCreated):
  
@@ -721,15 +901,23 @@ async def handle_date_input(event: MessageCreated):
     print(type(text))
   
     chat_id = event.message.recipient.chat_id
-    current_mode = user_modes.get(chat_id)
+    current_mode = await user_modes.get(chat_id)
     
     if current_mode == 'free_question':
        
-        await event.message.answer("⏳ Подождите, ваш вопрос обрабатывается...", attachments=None)
+        status = await event.message.answer("⏳ Подождите, ваш вопрос обрабатывается...", attachments=None)
+        status_mid = getattr(getattr(getattr(status, 'message', None), 'body', None), 'mid', None)
+        logging.info(f"Очередь LLM: {llm_pool.stats()}, кэш ответов: {answer_cache.stats()}")
 
         try:
-            
-            answer, s = qa_ai(qa_chain, text)
+            answer, s = await generate_free_answer(text, status_mid)
+        except asyncio.TimeoutError:
+            logging.error(f"Превышено время ожидания ответа (free_question) для chat_id {chat_id}")
+            await event.message.answer(
+                "⌛ Система сейчас перегружена, ответ не успел сформироваться. Попробуйте ещё раз или используйте /cancel.",
+                attachments=[get_main_menu()]
+            )
+            return
         except Exception as e:
             logging.error(f"Ошибка при генерации ответа (free_question): {e}")
             await event.message.answer(
@@ -738,20 +926,37 @@ async def handle_date_input(event: MessageCreated):
             )
             return
 
-        await event.message.answer(
+        final_text = (
             f"🔍 *Ответ (в разработке):* {answer}\n\n"
             f"🔍 *📚 Источники (в разработке):* {s}\n\n"
             f"Для выхода из режима используйте /cancel"
         )
+        if not await edit_message_text(status_mid, final_text):
+            await event.message.answer(final_text)
         return
 
    
     if current_mode == 'navigation':
+        # Быстрый путь: здание и аудитория понятны из текста, LLM не нужна
+        resolved = navigation_images.resolve(text)
+        if resolved:
+            building, room = resolved
+            logging.info(f"Навигация без LLM: здание '{building}', аудитория '{room}'")
+            await send_navigation_images(event, navigation_images.lookup(building, room))
+            return
+
         await event.message.answer("⏳ Подождите, ваш навигационный запрос обрабатывается...", attachments=None)
+        logging.info(f"Очередь LLM: {llm_pool.stats()}")
 
         try:
-            qa_chain_map = init_bot2(prompt=PROMPT2)
-            answer = qa_ai_nav(qa_chain_map, text)
+            answer = await llm_pool.run(qa_ai_nav, qa_chain_map, text)
+        except asyncio.TimeoutError:
+            logging.error(f"Превышено время ожидания ответа (navigation) для chat_id {chat_id}")
+            await event.message.answer(
+                "⌛ Система сейчас перегружена, ответ не успел сформироваться. Попробуйте ещё раз или используйте /cancel.",
+                attachments=[get_main_menu()]
+            )
+            return
         except Exception as e:
             logging.error(f"Ошибка при генерации ответа (navigation): {e}")
             await event.message.answer(
@@ -809,15 +1014,33 @@ async def handle_date_input(event: MessageCreated):
 
         pass
 
+async def warm_up():
+    try:
+        await llm_pool.run(warm_up_llm)
+    except asyncio.TimeoutError:
+        logging.warning("Прогрев модели не уложился в таймаут, продолжаем без него")
+
+
 async def main():
 
     await reminder_manager.init_db()
+    logging.info(f"Сессии пользователей: {await user_modes.stats()}")
+
+    # Прогрев модели в фоне, чтобы первый вопрос не ждал загрузки в Ollama
+    asyncio.create_task(warm_up())
     
   
     asyncio.create_task(reminder_manager.send_scheduled_reminders())
     
 
-    await dp.start_polling(bot)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        logging.info(f"Время обработки кнопок: {callback_router.stats()}")
+        logging.info(f"Сессии пользователей: {await user_modes.stats()}")
+        llm_pool.close()
+        await user_modes.close()
+        await reminder_manager.close()
 
 if __name__ == '__main__':
     asyncio.run(main())
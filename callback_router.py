@@ -0,0 +1,100 @@
+import bisect
+import logging
+from time import perf_counter
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограммы времени обработки, мс
+LATENCY_BUCKETS_MS = (1, 5, 10, 50, 100, 500, 1000, 5000)
+# Раз в сколько нажатий писать гистограммы в лог
+STATS_LOG_INTERVAL = 500
+
+
+class LatencyHistogram:
+    def __init__(self, buckets=LATENCY_BUCKETS_MS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0
+        self.sum_ms = 0.0
+        self.max_ms = 0.0
+
+    def observe(self, ms):
+        self.counts[bisect.bisect_left(self.buckets, ms)] += 1
+        self.total += 1
+        self.sum_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+
+    def summary(self):
+        labels = [f"<={b}ms" for b in self.buckets] + [f">{self.buckets[-1]}ms"]
+        return {
+            "count": self.total,
+            "avg_ms": round(self.sum_ms / self.total, 2) if self.total else 0.0,
+            "max_ms": round(self.max_ms, 2),
+            "buckets": {label: count for label, count in zip(labels, self.counts) if count},
+        }
+
+
+class CallbackRouter:
+    """
+    Маршрутизация payload кнопок: точные совпадения через словарь,
+    префиксы (q_, delete_, edit_text_) через префиксное дерево.
+    Для каждого обработчика собирается гистограмма времени работы.
+    """
+    def __init__(self):
+        self._exact = {}
+        self._trie = {}
+        self._default = None
+        self.latency = {}
+        self.dispatched = 0
+
+    def exact(self, *payloads):
+        def decorator(handler):
+            for payload in payloads:
+                self._exact[payload] = handler
+            return handler
+        return decorator
+
+    def prefix(self, prefix):
+        def decorator(handler):
+            node = self._trie
+            for ch in prefix:
+                node = node.setdefault(ch, {})
+            node[None] = handler
+            return handler
+        return decorator
+
+    def default(self, handler):
+        self._default = handler
+        return handler
+
+    def resolve(self, payload):
+        handler = self._exact.get(payload)
+        if handler is not None:
+            return handler
+
+        # Самый длинный зарегистрированный префикс payload
+        node = self._trie
+        handler = None
+        for ch in payload:
+            node = node.get(ch)
+            if node is None:
+                break
+            handler = node.get(None, handler)
+        return handler or self._default
+
+    async def dispatch(self, callback, payload, chat_id):
+        handler = self.resolve(payload)
+        if handler is None:
+            return
+        started = perf_counter()
+        try:
+            await handler(callback, payload, chat_id)
+        finally:
+            elapsed_ms = (perf_counter() - started) * 1000
+            self.latency.setdefault(handler.__name__, LatencyHistogram()).observe(elapsed_ms)
+            self.dispatched += 1
+            if self.dispatched % STATS_LOG_INTERVAL == 0:
+                logger.info(f"Время обработки кнопок: {self.stats()}")
+
+    def stats(self):
+        return {name: histogram.summary() for name, histogram in self.latency.items()}
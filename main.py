@@ -4,8 +4,8 @@
 import argparse
 from pathlib import Path
 from scripts.model_init import get_embedder
-from scripts.pdf_loader import add_pdfs_to_faiss_main
-from scripts.url_loader import crawl_and_update_faiss
+from scripts.pdf_loader import add_pdfs_to_faiss_main, PDF_WORKERS
+from scripts.url_loader import crawl_and_update_faiss, DEFAULT_CONCURRENCY, DEFAULT_PER_HOST
 from scripts.rag import start_rag_bot, start_nav_bot
 from scripts.json_loader import add_jsons_to_faiss_main, format_curators_json
 
@@ -19,13 +19,16 @@ def main():
     pdf_parser = subparsers.add_parser("pdf", help="Добавить PDF в FAISS")
     pdf_parser.add_argument("--pdf_dir", "-p", required=True, help="Directory with PDF files")
     pdf_parser.add_argument("--out", "-o", default=DEFAULT_OUT, help="Output folder")
+    pdf_parser.add_argument("--workers", "-w", type=int, default=PDF_WORKERS, help="Processes for PDF parsing")
 
     # URL
     url_parser = subparsers.add_parser("url", help="Обойти URL и обновить FAISS")
     url_parser.add_argument("--seeds", "-s", required=True, help="Seed URLs file")
     url_parser.add_argument("--out", "-o", default=DEFAULT_OUT, help="Output folder")
     url_parser.add_argument("--max_pages", "-m", type=int, default=100, help="Max pages to crawl")
-    url_parser.add_argument("--delay", "-d", type=float, default=0.2, help="Delay between requests")
+    url_parser.add_argument("--delay", "-d", type=float, default=0.2, help="Delay between requests to the same host")
+    url_parser.add_argument("--concurrency", "-c", type=int, default=DEFAULT_CONCURRENCY, help="Pages fetched in parallel")
+    url_parser.add_argument("--per_host", type=int, default=DEFAULT_PER_HOST, help="Parallel requests to one host")
 
     # JSON
     json_parser = subparsers.add_parser("json", help="Добавить JSON файлы из папки в FAISS")
@@ -50,10 +53,11 @@ def main():
 
     if args.command == "pdf":
         pdf_dir = Path(args.pdf_dir)
-        add_pdfs_to_faiss_main(pdf_dir, args.out, embedder)
+        add_pdfs_to_faiss_main(pdf_dir, args.out, embedder, workers=args.workers)
 
     elif args.command == "url":
-        crawl_and_update_faiss(embedder, args.seeds, args.out, max_pages=args.max_pages, delay=args.delay)
+        crawl_and_update_faiss(embedder, args.seeds, args.out, max_pages=args.max_pages, delay=args.delay,
+                               concurrency=args.concurrency, per_host=args.per_host)
 
     elif args.command == "chat":
         start_rag_bot(embedder, Path(args.out))
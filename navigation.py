@@ -0,0 +1,130 @@
+import logging
+import os
+import re
+import time
+import unicodedata
+import urllib.parse
+
+logger = logging.getLogger(__name__)
+
+IMG_DIR = 'img'
+# Картинки отдаются студентам ссылками на GitHub, а наличие файла проверяется по локальной папке img/
+IMG_BASE_URL = "https://raw.githubusercontent.com/oleffr/vk_hackaton_bot/main/img"
+# Как часто (в секундах) проверять, не изменилась ли папка с картинками
+INDEX_CHECK_INTERVAL = 60
+
+# <аудитория>_<номер схемы>.jpg, номер схемы может отсутствовать: 101_.jpg, 206_1.jpg
+IMAGE_NAME_RE = re.compile(r'^(?P<room>.+)_(?P<n>\d*)\.jpe?g$', re.IGNORECASE)
+
+# Как студенты называют здания: папка в img/ -> регулярные выражения по тексту в нижнем регистре
+BUILDING_SYNONYMS = {
+    'ГЗ': [
+        r'\bгз\b',
+        r'\bглавн\w*\s+(?:учебн\w*\s+)?(?:здани|корпус)\w*',
+    ],
+}
+BUILDING_PATTERNS = [
+    (building, re.compile(pattern))
+    for building, patterns in BUILDING_SYNONYMS.items()
+    for pattern in patterns
+]
+# Номер аудитории: 2-4 цифры и, возможно, буква (101, 101а)
+ROOM_RE = re.compile(r'(?<!\w)(\d{2,4}[а-яa-z]?)(?!\w)')
+
+
+def normalize_key(s):
+    return unicodedata.normalize('NFC', s).strip().lower()
+
+
+class NavigationImageIndex:
+    """
+    Индекс схем проезда img/<здание>/<аудитория>_N.jpg в памяти.
+    Строится один раз при старте и пересобирается, когда меняется содержимое папки.
+    """
+    def __init__(self, img_dir=IMG_DIR, base_url=IMG_BASE_URL):
+        self.img_dir = img_dir
+        self.base_url = base_url
+        self.index = {}
+        self._mtimes = None
+        self._checked_at = 0.0
+
+    def _snapshot_mtimes(self):
+        mtimes = {}
+        try:
+            mtimes[self.img_dir] = os.stat(self.img_dir).st_mtime
+            for entry in os.scandir(self.img_dir):
+                if entry.is_dir():
+                    mtimes[entry.path] = entry.stat().st_mtime
+        except OSError as e:
+            logger.warning(f"Не удалось прочитать папку с картинками {self.img_dir}: {e}")
+        return mtimes
+
+    def rebuild(self):
+        index = {}
+        mtimes = self._snapshot_mtimes()
+        for building_dir in mtimes:
+            if building_dir == self.img_dir:
+                continue
+            building = os.path.basename(building_dir)
+            for entry in os.scandir(building_dir):
+                match = IMAGE_NAME_RE.match(entry.name)
+                if not entry.is_file() or not match:
+                    continue
+                key = (normalize_key(building), normalize_key(match.group('room')))
+                order = int(match.group('n')) if match.group('n') else 0
+                index.setdefault(key, []).append((order, building, entry.name))
+
+        self.index = {
+            key: [self._url(building, name) for _, building, name in sorted(files)]
+            for key, files in index.items()
+        }
+        self._mtimes = mtimes
+        self._checked_at = time.monotonic()
+        logger.info(f"Индекс навигационных картинок построен: {len(self.index)} аудиторий")
+
+    def _url(self, building, filename):
+        return f"{self.base_url}/{urllib.parse.quote(building)}/{urllib.parse.quote(filename)}"
+
+    def refresh_if_changed(self):
+        now = time.monotonic()
+        if self._mtimes is not None and now - self._checked_at < INDEX_CHECK_INTERVAL:
+            return
+        self._checked_at = now
+        if self._mtimes is None or self._snapshot_mtimes() != self._mtimes:
+            self.rebuild()
+
+    def lookup(self, building, room):
+        """Список URL схем для аудитории или пустой список"""
+        self.refresh_if_changed()
+        return self.index.get((normalize_key(building), normalize_key(room)), [])
+
+    def resolve(self, text):
+        """
+        Определяет (здание, аудиторию) прямо по тексту вопроса, без LLM.
+        Возвращает None, если в тексте несколько зданий/аудиторий или их не удалось понять.
+        """
+        self.refresh_if_changed()
+        norm = normalize_key(text)
+
+        buildings = {normalize_key(b) for b, pattern in BUILDING_PATTERNS if pattern.search(norm)}
+        if len(buildings) > 1:
+            return None
+
+        rooms = list(dict.fromkeys(ROOM_RE.findall(norm)))
+        if len(rooms) != 1:
+            return None
+        # Сначала точное совпадение (101а), затем только цифры (101)
+        variants = list(dict.fromkeys([rooms[0], re.sub(r'\D', '', rooms[0])]))
+
+        if not buildings:
+            # Здание не названо: угадываем только если аудитория есть ровно в одном здании
+            known = {b for b, r in self.index if r in variants}
+            if len(known) != 1:
+                return None
+            buildings = known
+
+        building = buildings.pop()
+        for room in variants:
+            if (building, room) in self.index:
+                return building, room
+        return building, variants[0]
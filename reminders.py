@@ -1,142 +1,346 @@
 import asyncio
 import aiosqlite
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, time
 import logging
 import os
+from time import monotonic
+
+from maxapi.exceptions.max import MaxConnection
+from maxapi.types.errors import Error
 
 logger = logging.getLogger(__name__)
 
+# Миграции схемы: версия -> список SQL. Текущая версия хранится в PRAGMA user_version.
+# Даты хранятся строкой ISO (YYYY-MM-DD), поэтому сравниваются и сортируются как текст.
+MIGRATIONS = {
+    1: [
+        "UPDATE reminders SET event_date = date(event_date) "
+        "WHERE date(event_date) IS NOT NULL AND event_date != date(event_date)",
+        "CREATE INDEX IF NOT EXISTS idx_reminders_chat_date ON reminders (chat_id, event_date)",
+        "CREATE INDEX IF NOT EXISTS idx_reminders_date ON reminders (event_date)",
+    ],
+    2: [
+        "CREATE TABLE IF NOT EXISTS scheduler_state (key TEXT PRIMARY KEY, value TEXT NOT NULL)",
+    ],
+}
+
+# Слоты рассылки: (время отправки, смещение даты события в днях, время суток, префикс)
+REMINDER_SLOTS = (
+    (time(9, 0), 0, "утро", "Сегодня"),
+    (time(18, 0), 1, "вечер", "Завтра"),
+)
+# Верхняя граница сна планировщика, чтобы переживать перевод часов и сон машины
+MAX_SCHEDULER_SLEEP = 3600
+
+# Параметры рассылки: Max API допускает около 30 запросов в секунду на бота
+SEND_RATE_LIMIT = float(os.environ.get("REMINDER_RATE_LIMIT", 25))
+SEND_CONCURRENCY = int(os.environ.get("REMINDER_CONCURRENCY", 10))
+SEND_BATCH_SIZE = 500
+SEND_RETRIES = 3
+SEND_RETRY_DELAY = 1.0
+# Временные ошибки Max API, после которых имеет смысл повторить отправку
+RETRYABLE_STATUS = {429}
+
+
+def to_db_date(value):
+    """Приводит дату к формату хранения в таблице reminders"""
+    if hasattr(value, "isoformat"):
+        if isinstance(value, datetime):
+            value = value.date()
+        return value.isoformat()
+    return str(value)
+
+
+class TokenBucket:
+    """Ограничитель частоты запросов: rate токенов в секунду, не более capacity подряд"""
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = monotonic()
+        self._lock = None
+
+    async def acquire(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            while True:
+                now = monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+def iter_due_slots(start, end):
+    """Слоты рассылки, наступившие в интервале (start, end], в порядке времени"""
+    day = start.date()
+    while day <= end.date():
+        for slot in REMINDER_SLOTS:
+            instant = datetime.combine(day, slot[0])
+            if start < instant <= end:
+                yield instant, slot
+        day += timedelta(days=1)
+
+
+def next_slot_after(moment):
+    """Ближайший слот рассылки строго после moment"""
+    day = moment.date()
+    while True:
+        for slot in REMINDER_SLOTS:
+            instant = datetime.combine(day, slot[0])
+            if instant > moment:
+                return instant, slot
+        day += timedelta(days=1)
+
+
 class ReminderManager:
     def __init__(self, bot):
         self.bot = bot
         self.db_path = 'reminders.db'
-        
+        # Одно долгоживущее соединение на весь процесс: aiosqlite держит для него
+        # отдельный поток, а sqlite3 кэширует подготовленные выражения между вызовами
+        self.db = None
+        self.rate_limiter = TokenBucket(SEND_RATE_LIMIT)
+
+    async def _get_db(self):
+        if self.db is None:
+            self.db = await aiosqlite.connect(self.db_path)
+            await self.db.execute("PRAGMA journal_mode=WAL")
+            await self.db.execute("PRAGMA synchronous=NORMAL")
+        return self.db
+
+    async def close(self):
+        if self.db is not None:
+            await self.db.close()
+            self.db = None
+            logger.info("Соединение с базой напоминаний закрыто")
+
     async def init_db(self):
-     
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute('''
-                CREATE TABLE IF NOT EXISTS reminders (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    chat_id INTEGER NOT NULL,
-                    reminder_text TEXT NOT NULL,
-                    event_date DATE NOT NULL,
-                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            await db.commit()
-        logger.info("База данных напоминаний инициализирована")
 
-    async def add_reminder(self, chat_id, text, event_date):
-   
-        async with aiosqlite.connect(self.db_path) as db:
-            cursor = await db.execute(
-                "INSERT INTO reminders (chat_id, reminder_text, event_date) VALUES (?, ?, ?)",
-                (chat_id, text, event_date)
+        db = await self._get_db()
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS reminders (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id INTEGER NOT NULL,
+                reminder_text TEXT NOT NULL,
+                event_date DATE NOT NULL,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP
             )
-            reminder_id = cursor.lastrowid
+        ''')
+        await db.commit()
+        await self._migrate(db)
+        logger.info("База данных напоминаний инициализирована")
+
+    async def _migrate(self, db):
+        async with db.execute("PRAGMA user_version") as cursor:
+            row = await cursor.fetchone()
+        version = row[0] if row else 0
+
+        for target in sorted(v for v in MIGRATIONS if v > version):
+            for statement in MIGRATIONS[target]:
+                await db.execute(statement)
+            # PRAGMA не поддерживает параметры, target - целое число из MIGRATIONS
+            await db.execute(f"PRAGMA user_version = {int(target)}")
             await db.commit()
+            logger.info(f"Схема напоминаний обновлена до версии {target}")
+
+    async def add_reminder(self, chat_id, text, event_date):
+
+        db = await self._get_db()
+        cursor = await db.execute(
+            "INSERT INTO reminders (chat_id, reminder_text, event_date) VALUES (?, ?, ?)",
+            (chat_id, text, to_db_date(event_date))
+        )
+        reminder_id = cursor.lastrowid
+        await db.commit()
         logger.info(f"Добавлено напоминание ID {reminder_id} для chat_id {chat_id}")
         return reminder_id
 
     async def get_user_reminders(self, chat_id):
-   
-        async with aiosqlite.connect(self.db_path) as db:
-            async with db.execute(
-                "SELECT id, reminder_text, event_date FROM reminders WHERE chat_id = ? ORDER BY event_date",
-                (chat_id,)
-            ) as cursor:
-                reminders = await cursor.fetchall()
+
+        db = await self._get_db()
+        async with db.execute(
+            "SELECT id, reminder_text, event_date FROM reminders WHERE chat_id = ? ORDER BY event_date",
+            (chat_id,)
+        ) as cursor:
+            reminders = await cursor.fetchall()
         return reminders
 
     async def get_week_reminders(self, chat_id):
-     
+
         today = datetime.now().date()
         week_end = today + timedelta(days=7)
-        
-        async with aiosqlite.connect(self.db_path) as db:
-            async with db.execute(
-                "SELECT id, reminder_text, event_date FROM reminders WHERE chat_id = ? AND event_date BETWEEN ? AND ? ORDER BY event_date",
-                (chat_id, today, week_end)
-            ) as cursor:
-                reminders = await cursor.fetchall()
+
+        db = await self._get_db()
+        async with db.execute(
+            "SELECT id, reminder_text, event_date FROM reminders WHERE chat_id = ? AND event_date BETWEEN ? AND ? ORDER BY event_date",
+            (chat_id, to_db_date(today), to_db_date(week_end))
+        ) as cursor:
+            reminders = await cursor.fetchall()
         return reminders
 
     async def get_reminders_by_date(self, chat_id, target_date):
-     
-        async with aiosqlite.connect(self.db_path) as db:
-            async with db.execute(
-                "SELECT id, reminder_text, event_date FROM reminders WHERE chat_id = ? AND event_date = ? ORDER BY event_date",
-                (chat_id, target_date)
-            ) as cursor:
-                reminders = await cursor.fetchall()
+
+        db = await self._get_db()
+        async with db.execute(
+            "SELECT id, reminder_text, event_date FROM reminders WHERE chat_id = ? AND event_date = ? ORDER BY event_date",
+            (chat_id, to_db_date(target_date))
+        ) as cursor:
+            reminders = await cursor.fetchall()
         return reminders
 
     async def delete_reminder(self, reminder_id, chat_id):
-      
-        async with aiosqlite.connect(self.db_path) as db:
-            cursor = await db.execute(
-                "DELETE FROM reminders WHERE id = ? AND chat_id = ?",
-                (reminder_id, chat_id)
-            )
-            rows_affected = cursor.rowcount
-            await db.commit()
+
+        db = await self._get_db()
+        cursor = await db.execute(
+            "DELETE FROM reminders WHERE id = ? AND chat_id = ?",
+            (reminder_id, chat_id)
+        )
+        rows_affected = cursor.rowcount
+        await db.commit()
         logger.info(f"Удалено напоминание {reminder_id} для chat_id {chat_id}, удалено строк: {rows_affected}")
         return rows_affected > 0
 
     async def update_reminder_text(self, reminder_id, chat_id, new_text):
-   
-        async with aiosqlite.connect(self.db_path) as db:
-            cursor = await db.execute(
-                "UPDATE reminders SET reminder_text = ? WHERE id = ? AND chat_id = ?",
-                (new_text, reminder_id, chat_id)
-            )
-            rows_affected = cursor.rowcount
-            await db.commit()
+
+        db = await self._get_db()
+        cursor = await db.execute(
+            "UPDATE reminders SET reminder_text = ? WHERE id = ? AND chat_id = ?",
+            (new_text, reminder_id, chat_id)
+        )
+        rows_affected = cursor.rowcount
+        await db.commit()
         logger.info(f"Обновлен текст напоминания {reminder_id} для chat_id {chat_id}, изменено строк: {rows_affected}")
         return rows_affected > 0
 
+    async def _get_state(self, key):
+        db = await self._get_db()
+        async with db.execute("SELECT value FROM scheduler_state WHERE key = ?", (key,)) as cursor:
+            row = await cursor.fetchone()
+        return row[0] if row else None
+
+    async def _set_state(self, key, value):
+        db = await self._get_db()
+        await db.execute(
+            "INSERT INTO scheduler_state (key, value) VALUES (?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+            (key, str(value))
+        )
+        await db.commit()
+
+    async def _delete_state(self, key):
+        db = await self._get_db()
+        await db.execute("DELETE FROM scheduler_state WHERE key = ?", (key,))
+        await db.commit()
+
     async def send_scheduled_reminders(self):
-        
+        """
+        Фоновая рассылка. Спит ровно до следующего слота, а время последнего
+        обработанного слота хранит в scheduler_state, поэтому после перезапуска
+        досылает пропущенные сегодня слоты и не повторяет уже отправленные.
+        """
+        watermark = await self._get_state("last_slot")
+        if watermark is None:
+            watermark = datetime.now()
+            await self._set_state("last_slot", watermark.isoformat())
+        else:
+            watermark = datetime.fromisoformat(watermark)
+
         while True:
             try:
                 now = datetime.now()
-                current_time = now.time()
-                current_date = now.date()
-                
-              
-                if current_time.hour == 18 and current_time.minute == 0:
-                    tomorrow = current_date + timedelta(days=1)
-                    await self._send_reminders_for_date(tomorrow, "вечер", "Завтра")
-                
-             
-                elif current_time.hour == 9 and current_time.minute == 0:
-                    await self._send_reminders_for_date(current_date, "утро", "Сегодня")
-                    
+                for instant, (_, day_offset, time_of_day, prefix) in iter_due_slots(watermark, now):
+                    if instant.date() == now.date():
+                        target_date = instant.date() + timedelta(days=day_offset)
+                        await self._send_reminders_for_date(
+                            target_date, time_of_day, prefix, slot_key=instant.isoformat()
+                        )
+                    else:
+                        logger.warning(f"Пропущен устаревший слот рассылки {instant}")
+                    watermark = instant
+                    await self._set_state("last_slot", watermark.isoformat())
+
+                next_instant, _ = next_slot_after(max(watermark, now))
+                delay = min((next_instant - datetime.now()).total_seconds(), MAX_SCHEDULER_SLEEP)
             except Exception as e:
                 logger.error(f"Ошибка в фоновой задаче: {e}")
-            
-            await asyncio.sleep(60)
+                delay = 60
 
-    async def _send_reminders_for_date(self, target_date, time_of_day, prefix):
-      
-        async with aiosqlite.connect(self.db_path) as db:
-            async with db.execute(
-                "SELECT chat_id, reminder_text FROM reminders WHERE event_date = ?",
-                (target_date,)
-            ) as cursor:
-                reminders = await cursor.fetchall()
-                
-            for chat_id, text in reminders:
+            await asyncio.sleep(max(delay, 0))
+
+    async def _deliver(self, chat_id, message, semaphore):
+        """Отправка одного напоминания с ограничением частоты и повторами"""
+        async with semaphore:
+            for attempt in range(1, SEND_RETRIES + 1):
+                await self.rate_limiter.acquire()
                 try:
-                    message = f"🔔 {prefix}: {text}"
-                    await self.bot.send_message(
-                        chat_id=chat_id, 
-                        text=message
-                    )
-                    logger.info(f"Отправлено {time_of_day}нее напоминание пользователю {chat_id}")
+                    # maxapi не бросает исключение на HTTP-ошибку, а возвращает Error
+                    result = await self.bot.send_message(chat_id=chat_id, text=message)
+                except (MaxConnection, asyncio.TimeoutError) as e:
+                    error, retryable = e, True
                 except Exception as e:
-                    logger.error(f"Ошибка отправки напоминания {chat_id}: {e}")
-            
-            # Удаляем прошедшие напоминания
-            await db.execute("DELETE FROM reminders WHERE event_date < ?", (datetime.now().date(),))
-            await db.commit()
+                    error, retryable = e, False
+                else:
+                    if not isinstance(result, Error):
+                        return True
+                    error = f"HTTP {result.code}: {result.raw}"
+                    retryable = result.code in RETRYABLE_STATUS or result.code >= 500
+
+                if not retryable or attempt == SEND_RETRIES:
+                    logger.error(f"Ошибка отправки напоминания {chat_id}: {error}")
+                    return False
+                delay = SEND_RETRY_DELAY * 2 ** (attempt - 1)
+                logger.warning(f"Ошибка отправки напоминания {chat_id} (попытка {attempt}): {error}, повтор через {delay}s")
+                await asyncio.sleep(delay)
+
+    async def _send_reminders_for_date(self, target_date, time_of_day, prefix, slot_key=None):
+        # Для слота планировщика запоминаем последний отправленный id,
+        # чтобы прерванная рассылка продолжилась с того же места
+        progress_key = f"progress:{slot_key}" if slot_key else None
+        last_id = 0
+        if progress_key:
+            last_id = int(await self._get_state(progress_key) or 0)
+
+        db = await self._get_db()
+        semaphore = asyncio.Semaphore(SEND_CONCURRENCY)
+        sent_total = 0
+        failed_total = 0
+
+        while True:
+            # Читаем напоминания порциями по id, не держа курсор открытым во время отправки
+            async with db.execute(
+                "SELECT id, chat_id, reminder_text FROM reminders WHERE event_date = ? AND id > ? ORDER BY id LIMIT ?",
+                (to_db_date(target_date), last_id, SEND_BATCH_SIZE)
+            ) as cursor:
+                batch = await cursor.fetchall()
+            if not batch:
+                break
+
+            started = monotonic()
+            results = await asyncio.gather(*(
+                self._deliver(chat_id, f"🔔 {prefix}: {text}", semaphore)
+                for _, chat_id, text in batch
+            ))
+            elapsed = monotonic() - started
+
+            sent = sum(results)
+            sent_total += sent
+            failed_total += len(results) - sent
+            last_id = batch[-1][0]
+            if progress_key:
+                await self._set_state(progress_key, last_id)
+            logger.info(
+                f"Отправлена порция {time_of_day}них напоминаний: {sent}/{len(batch)} "
+                f"за {elapsed:.1f}s ({len(batch) / max(elapsed, 1e-6):.1f} сообщ./с)"
+            )
+
+        if progress_key:
+            await self._delete_state(progress_key)
+        logger.info(f"Рассылка на {target_date} завершена: отправлено {sent_total}, ошибок {failed_total}")
+
+        # Удаляем прошедшие напоминания
+        await db.execute("DELETE FROM reminders WHERE event_date < ?", (to_db_date(datetime.now().date()),))
+        await db.commit()
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+Кэш ответов RAG-бота: точное совпадение нормализованного вопроса
+и похожие вопросы по косинусной близости эмбеддингов.
+"""
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from scripts.model_init import get_faiss_path
+
+DEFAULT_MAX_SIZE = 1000
+DEFAULT_TTL = 24 * 3600
+DEFAULT_SIMILARITY = 0.92
+
+
+def normalize_query(text: str) -> str:
+    text = text.lower().replace("ё", "е")
+    text = re.sub(r"[^\w\s]", " ", text)
+    return " ".join(text.split())
+
+
+class AnswerCache:
+    """
+    LRU-кэш с TTL. Сбрасывается целиком через reset(), когда бот перезагрузил
+    пересобранный FAISS-индекс из kb_path: index_changed() подсказывает, что пора.
+    Все методы потокобезопасны: вызовы идут из пула потоков AsyncInference.
+    """
+    def __init__(self, embedder=None, kb_path: str = "kb_output", max_size: int = DEFAULT_MAX_SIZE,
+                 ttl: float = DEFAULT_TTL, similarity: float = DEFAULT_SIMILARITY):
+        self.embedder = embedder
+        self.index_file = os.path.join(get_faiss_path(kb_path), "index.faiss")
+        self.max_size = max_size
+        self.ttl = ttl
+        self.similarity = similarity
+        # нормализованный вопрос -> (единичный вектор или None, ответ, время записи)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.index_mtime = self.get_index_mtime()
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+
+    def get_index_mtime(self):
+        try:
+            return os.path.getmtime(self.index_file)
+        except OSError:
+            return None
+
+    def index_changed(self):
+        """Индекс на диске изменился с тех пор, как под него собирался кэш"""
+        return self.get_index_mtime() != self.index_mtime
+
+    def reset(self, index_mtime):
+        """Очищает кэш: ответы, полученные по старому индексу, больше не годятся"""
+        with self._lock:
+            self._entries.clear()
+            self.index_mtime = index_mtime
+        print("[INFO] FAISS-индекс обновлён, кэш ответов очищен")
+
+    def _embed(self, text):
+        if self.embedder is None:
+            return None
+        try:
+            vector = np.asarray(self.embedder.embed_query(text), dtype=np.float32)
+        except Exception as e:
+            print(f"[WARN] Не удалось получить эмбеддинг для кэша: {e}")
+            return None
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else None
+
+    def _find_similar(self, vector):
+        keys = [k for k, entry in self._entries.items() if entry[0] is not None]
+        if vector is None or not keys:
+            return None
+        matrix = np.stack([self._entries[k][0] for k in keys])
+        scores = matrix @ vector
+        best = int(np.argmax(scores))
+        if scores[best] >= self.similarity:
+            return keys[best]
+        return None
+
+    def _evict_expired(self, now):
+        while self._entries:
+            key, (_, _, created) = next(iter(self._entries.items()))
+            if now - created < self.ttl:
+                break
+            self._entries.popitem(last=False)
+
+    def get(self, text):
+        """Только точное совпадение, без эмбеддингов: можно вызывать прямо из event loop"""
+        key = normalize_query(text)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.time() - entry[2] < self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+        return None
+
+    def get_or_compute(self, text, compute):
+        """Возвращает ответ из кэша или вызывает compute() и сохраняет результат"""
+        cached = self.get(text)
+        if cached is not None:
+            return cached
+
+        key = normalize_query(text)
+        now = time.time()
+        vector = self._embed(key)
+
+        with self._lock:
+            similar = self._find_similar(vector)
+            if similar is not None and now - self._entries[similar][2] < self.ttl:
+                self._entries.move_to_end(similar)
+                self.semantic_hits += 1
+                return self._entries[similar][1]
+            self.misses += 1
+
+        value = compute()
+
+        with self._lock:
+            self._entries[key] = (vector, value, time.time())
+            self._entries.move_to_end(key)
+            self._evict_expired(now)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "semantic_hits": self.semantic_hits,
+                "misses": self.misses,
+            }
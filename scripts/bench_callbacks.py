@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Бенчмарк обработки нажатий кнопок: bot.handle_button_click с заглушкой
+callback.message.answer в трёх режимах:
+  кэш           - клавиатуры собраны заранее и переиспользуются (как в боте);
+  сборка        - каждая клавиатура строится заново на каждый клик (как до кэша);
+  перечитывание - categories.json "изменился" перед каждым кликом, и
+                  reload_categories_if_changed пересобирает все меню FAQ.
+С --questions N меню FAQ берутся из синтетического categories.json
+(--categories категорий по N вопросов), иначе из настоящего.
+
+    python -m scripts.bench_callbacks --clicks 2000
+    python -m scripts.bench_callbacks --categories 20 --questions 100
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import statistics
+import tempfile
+import time
+from types import SimpleNamespace
+
+import bot
+
+STATIC_PAYLOADS = ["back_to_main", "faq_categories", "reminders_menu", "bot_help"]
+
+
+def make_callback(payload, answers):
+    async def answer(text, attachments=None):
+        answers.append(attachments)
+
+    message = SimpleNamespace(answer=answer, recipient=SimpleNamespace(chat_id=1))
+    return SimpleNamespace(message=message, callback=SimpleNamespace(payload=payload))
+
+
+def write_synthetic_categories(path, categories, questions):
+    data = {
+        f"menu_bench{c}": {
+            "title": f"Категория {c}",
+            "questions": [f"Вопрос {q} категории {c}: как получить справку номер {q}?" for q in range(questions)],
+        }
+        for c in range(categories)
+    }
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+
+
+def use_categories(path):
+    bot.CATEGORIES_PATH = path
+    bot.categories_mtime = None
+    bot.reload_categories_if_changed()
+
+
+@contextlib.contextmanager
+def uncached_menus():
+    """Клавиатуры строятся на каждый клик, как до build_faq_menus и lru_cache"""
+    saved = {name: getattr(bot, name) for name in
+             ("get_main_menu", "get_reminders_menu", "get_faq_categories_menu", "get_questions_menu")}
+    bot.get_main_menu = saved["get_main_menu"].__wrapped__
+    bot.get_reminders_menu = saved["get_reminders_menu"].__wrapped__
+    bot.get_faq_categories_menu = bot.build_faq_categories_menu
+    bot.get_questions_menu = bot.build_questions_menu
+    try:
+        yield
+    finally:
+        for name, func in saved.items():
+            setattr(bot, name, func)
+
+
+async def run_clicks(payloads, clicks, before_click=None):
+    """Время обработки одного нажатия, мкс, для каждого вида payload"""
+    answers = []
+    timings = {}
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for i in range(clicks):
+            kind, payload = payloads[i % len(payloads)]
+            if before_click:
+                before_click()
+            callback = make_callback(payload, answers)
+            started = time.perf_counter()
+            await bot.handle_button_click(callback)
+            timings.setdefault(kind, []).append((time.perf_counter() - started) * 1e6)
+    assert len(answers) == clicks
+    return timings
+
+
+def summary(samples):
+    samples = sorted(samples)
+    return statistics.mean(samples), samples[int(len(samples) * 0.95) - 1]
+
+
+async def bench(clicks):
+    payloads = [("статичное меню", p) for p in STATIC_PAYLOADS]
+    payloads += [("категория FAQ", category) for category in bot.categories_data]
+    payloads += [("вопрос FAQ", payload) for payload in bot.faq_answers_by_id]
+
+    # Один прогон вхолостую, чтобы lru_cache и импорты не попали в замер
+    await run_clicks(payloads, len(payloads))
+    results = {"кэш": await run_clicks(payloads, clicks)}
+    with uncached_menus():
+        results["сборка"] = await run_clicks(payloads, clicks)
+
+    def touch():
+        bot.categories_mtime = None
+
+    results["перечитывание"] = await run_clicks(payloads, clicks, before_click=touch)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк обработки нажатий кнопок")
+    parser.add_argument("--clicks", type=int, default=2000)
+    parser.add_argument("--categories", type=int, default=10, help="Категорий в синтетическом categories.json")
+    parser.add_argument("--questions", type=int, default=0,
+                        help="Вопросов в категории; 0 - настоящий categories.json")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.questions:
+            path = os.path.join(tmp, "categories.json")
+            write_synthetic_categories(path, args.categories, args.questions)
+            use_categories(path)
+        logging.disable(logging.CRITICAL)
+        questions = sum(len(data["questions"]) for data in bot.categories_data.values())
+        print(f"Категорий: {len(bot.categories_data)}, вопросов: {questions}, нажатий в режиме: {args.clicks}")
+        results = asyncio.run(bench(args.clicks))
+
+    modes = list(results)
+    print(f"\n{'кнопка':<16}" + "".join(f"{mode + ', мкс (p95)':>26}" for mode in modes))
+    for kind in results["кэш"]:
+        cells = []
+        for mode in modes:
+            mean, p95 = summary(results[mode][kind])
+            cells.append(f"{mean:>14.1f} ({p95:>8.1f})")
+        print(f"{kind:<16}" + "".join(f"{cell:>26}" for cell in cells))
+
+
+if __name__ == "__main__":
+    main()
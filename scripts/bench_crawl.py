@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Бенчмарк обхода сайтов на локальной заглушке: crawl() с concurrency=1, per_host=1
+(последовательный обход) против настроек по умолчанию. Заглушка поднимает --hosts
+сайтов на разных портах, по --pages страниц с ссылками друг на друга, каждая страница
+отдаётся с задержкой --latency-ms.
+
+    python -m scripts.bench_crawl --hosts 3 --pages 60 --latency-ms 50 --delay 0.1
+"""
+import argparse
+import contextlib
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from scripts.url_loader import crawl, DEFAULT_CONCURRENCY, DEFAULT_PER_HOST
+
+LINKS_PER_PAGE = 5
+PARAGRAPH = "Студентам первого курса нужно оформить пропуск, студенческий билет и читательский билет. "
+
+
+def make_handler(pages, latency_ms):
+    class StubSite(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            time.sleep(latency_ms / 1000)
+            try:
+                page = int(self.path.strip("/").split("/")[-1] or 0)
+            except ValueError:
+                page = -1
+            if not 0 <= page < pages:
+                self.send_error(404)
+                return
+            links = "".join(f'<li><a href="/page/{(page * 7 + k) % pages}">Раздел {k}</a></li>'
+                            for k in range(1, LINKS_PER_PAGE + 1))
+            html = (f"<html><head><title>Страница {page}</title></head><body>"
+                    f"<nav><ul>{links}</ul></nav><main><h1>Страница {page}</h1>"
+                    f"<p>{PARAGRAPH * 20}</p></main><footer>Политех</footer></body></html>")
+            data = html.encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    return StubSite
+
+
+def run(seeds, max_pages, delay, concurrency, per_host):
+    started = time.perf_counter()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        urls, pages = crawl(seeds, max_pages=max_pages, delay=delay, concurrency=concurrency, per_host=per_host)
+    elapsed = time.perf_counter() - started
+    crawled = sum(1 for url in urls if pages.get(url, {}).get("text"))
+    return crawled, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк обхода на локальной заглушке сайтов")
+    parser.add_argument("--hosts", type=int, default=3)
+    parser.add_argument("--pages", type=int, default=60, help="Страниц на каждом сайте")
+    parser.add_argument("--latency-ms", type=float, default=50, help="Время ответа сервера на страницу")
+    parser.add_argument("--delay", type=float, default=0.1, help="Пауза между запросами к одному хосту")
+    args = parser.parse_args()
+
+    servers = []
+    for _ in range(args.hosts):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(args.pages, args.latency_ms))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+    seeds = [f"http://127.0.0.1:{server.server_port}/" for server in servers]
+    max_pages = args.hosts * args.pages
+
+    results = {
+        "concurrency=1, per_host=1": run(seeds, max_pages, args.delay, 1, 1),
+        f"concurrency={DEFAULT_CONCURRENCY}, per_host={DEFAULT_PER_HOST}":
+            run(seeds, max_pages, args.delay, DEFAULT_CONCURRENCY, DEFAULT_PER_HOST),
+    }
+    for server in servers:
+        server.shutdown()
+
+    print(f"\nСайтов: {args.hosts} по {args.pages} страниц, ответ {args.latency_ms:.0f} мс, "
+          f"пауза на хост {args.delay} с")
+    print(f"{'настройки':<28} {'страниц':>8} {'время, с':>9} {'страниц/с':>10}")
+    for name, (crawled, elapsed) in results.items():
+        print(f"{name:<28} {crawled:>8} {elapsed:>9.1f} {crawled / elapsed:>10.1f}")
+    sequential, default = (crawled / elapsed for crawled, elapsed in results.values())
+    print(f"Ускорение: x{default / sequential:.1f}")
+
+
+if __name__ == "__main__":
+    main()
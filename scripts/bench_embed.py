@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Бенчмарк эмбеддингов на заглушке Ollama: пакетный /api/embed против поштучного /api/embeddings.
+Заглушка имитирует накладные расходы на запрос и время на каждый текст, поэтому
+результат показывает выигрыш от пакетной отправки без настоящей модели.
+
+    python -m scripts.bench_embed --texts 2000 --request-ms 20 --text-ms 1
+"""
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from scripts.model_init import OllamaEmbeddings, embed_in_batches
+
+DIMENSION = 384
+
+
+def make_handler(request_ms, text_ms):
+    class StubOllama(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True  # иначе заголовки и тело ответа ждут delayed ACK клиента
+
+        def log_message(self, *args):
+            pass
+
+        def _vector(self, text):
+            rng = np.random.default_rng(abs(hash(text)) % 2 ** 32)
+            return rng.standard_normal(DIMENSION).tolist()
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            if self.path == "/api/embed":
+                texts = body["input"]
+                payload = {"embeddings": [self._vector(t) for t in texts]}
+            else:
+                texts = [body["prompt"]]
+                payload = {"embedding": self._vector(texts[0])}
+            time.sleep((request_ms + text_ms * len(texts)) / 1000)
+            data = json.dumps(payload).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    return StubOllama
+
+
+def run(embedder, texts, batch_size, workers):
+    started = time.perf_counter()
+    embeddings, report = embed_in_batches(texts, embedder, batch_size, workers)
+    elapsed = time.perf_counter() - started
+    assert report["failed"] == 0 and len(embeddings) == len(texts)
+    return len(texts) / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк пакетных эмбеддингов на заглушке Ollama")
+    parser.add_argument("--texts", type=int, default=2000)
+    parser.add_argument("--request-ms", type=float, default=20, help="Накладные расходы на запрос")
+    parser.add_argument("--text-ms", type=float, default=1, help="Время на один текст")
+    parser.add_argument("--batch_size", type=int, default=256)
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(args.request_ms, args.text_ms))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    texts = [f"Фрагмент базы знаний номер {i}. " * 10 for i in range(args.texts)]
+
+    legacy = OllamaEmbeddings(base_url=base_url)
+    legacy._batch_supported = False  # только /api/embeddings, как до пакетной отправки
+    batched = OllamaEmbeddings(base_url=base_url)
+
+    results = {
+        "/api/embeddings": run(legacy, texts, args.batch_size, args.workers),
+        "/api/embed": run(batched, texts, args.batch_size, args.workers),
+    }
+    server.shutdown()
+
+    print()
+    for name, rate in results.items():
+        print(f"{name:<18} {rate:10.1f} чанков/с")
+    print(f"Ускорение: x{results['/api/embed'] / results['/api/embeddings']:.1f}")
+
+
+if __name__ == "__main__":
+    main()
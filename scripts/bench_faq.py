@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Бенчмарк поиска ответа FAQ: прежний перебор normalized_faq_data против
+обратного индекса слов из bot.get_answer. FAQ подменяется синтетическим
+(по умолчанию 10 000 вопросов), логирование на время замеров отключено.
+
+    python -m scripts.bench_faq --entries 10000 --queries 200
+"""
+import argparse
+import logging
+import random
+import time
+
+import bot
+
+# Частые слова встречаются во многих вопросах и дают длинные списки в индексе
+COMMON_WORDS = ["как", "где", "когда", "можно", "ли", "получить", "оформить", "найти", "в", "на",
+                "для", "студенту", "первокурснику", "справку", "общежитие", "стипендию", "расписание"]
+NOT_FOUND = "Ответ на данный вопрос временно недоступен."
+
+
+def legacy_get_answer(question, faq):
+    """get_answer до индекса: прямой ключ, повторный перебор и поиск подстроки в обе стороны"""
+    normalized_question = bot.normalize_string(question)
+    logging.info(f"Поиск ответа для: '{question}' -> нормализовано: '{normalized_question}'")
+
+    if normalized_question in faq:
+        return faq[normalized_question]
+
+    for faq_question, answer in faq.items():
+        if normalized_question == faq_question:
+            return answer
+
+    for faq_question, answer in faq.items():
+        if normalized_question in faq_question or faq_question in normalized_question:
+            return answer
+
+    logging.warning(f"Ответ не найден для: '{normalized_question}'")
+    logging.warning(f"Доступные ключи в FAQ (первые 5): {list(faq.keys())[:5]}")
+    return NOT_FOUND
+
+
+def make_faq(entries, rng):
+    faq = {}
+    while len(faq) < entries:
+        words = rng.sample(COMMON_WORDS, 3) + [f"термин{rng.randrange(entries)}" for _ in range(rng.randint(3, 6))]
+        faq[" ".join(words) + "?"] = f"Ответ {len(faq)}"
+    return faq
+
+
+def make_queries(faq, count, rng):
+    keys = list(faq)
+    queries = {"точный": [], "часть вопроса": [], "перефразированный": [], "нет в FAQ": []}
+    for _ in range(count):
+        words = rng.choice(keys).split()
+        queries["точный"].append(" ".join(words))
+        queries["часть вопроса"].append(" ".join(words[1:]))
+        shuffled = words[:-1] + [words[-1].rstrip("?")]
+        rng.shuffle(shuffled)
+        queries["перефразированный"].append(" ".join(shuffled))
+        queries["нет в FAQ"].append(" ".join(rng.sample(COMMON_WORDS, 2) + [f"неттакого{rng.randrange(10 ** 6)}"]))
+    return queries
+
+
+def measure(lookup, queries):
+    found = 0
+    started = time.perf_counter()
+    for query in queries:
+        if lookup(query) != NOT_FOUND:
+            found += 1
+    return (time.perf_counter() - started) / len(queries) * 1e6, found
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк поиска по FAQ")
+    parser.add_argument("--entries", type=int, default=10_000)
+    parser.add_argument("--queries", type=int, default=200, help="Запросов каждого вида")
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    faq = make_faq(args.entries, rng)
+    queries = make_queries(faq, args.queries, rng)
+
+    started = time.perf_counter()
+    bot.normalized_faq_data = faq
+    bot.faq_tokens, bot.faq_token_index, bot.faq_rare_index = bot.build_faq_index(faq)
+    print(f"Индекс на {len(faq)} вопросов построен за {(time.perf_counter() - started) * 1000:.0f} мс")
+
+    logging.disable(logging.CRITICAL)
+    print(f"\n{'запрос':<20} {'перебор, мкс':>13} {'индекс, мкс':>12} {'ускорение':>10} {'найдено до/после':>17}")
+    for name, batch in queries.items():
+        old_us, old_found = measure(lambda q: legacy_get_answer(q, faq), batch)
+        new_us, new_found = measure(bot.get_answer, batch)
+        print(f"{name:<20} {old_us:13.1f} {new_us:12.1f} {old_us / max(new_us, 1e-9):9.1f}x "
+              f"{old_found:>8}/{new_found:<8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Бенчмарк разбора HTML: процессорное время на страницу для каждого доступного
+бэкенда parse_html (selectolax, bs4+lxml, bs4+html.parser) и для прежнего
+двойного разбора html.parser. Страницы берутся из каталога сохранённых .html
+(--corpus), иначе генерируется синтетический корпус, похожий на страницы вуза.
+Неустановленные бэкенды пропускаются.
+
+    python -m scripts.bench_parse --corpus saved_pages --repeat 3
+    python -m scripts.bench_parse --pages 50
+"""
+import argparse
+import contextlib
+import random
+import statistics
+import time
+from pathlib import Path
+
+from bs4 import BeautifulSoup
+
+import scripts.url_loader as url_loader
+
+SENTENCE = ("Приём документов на обучение по программам бакалавриата проводится в "
+            "приёмной комиссии главного здания с понедельника по пятницу. ")
+
+
+def legacy_parse_html(html):
+    """parse_html до выбора бэкенда: текст и ссылки из двух отдельных разборов html.parser"""
+    soup = BeautifulSoup(html, "html.parser")
+    for tag in soup(url_loader.NOISE_TAGS):
+        tag.decompose()
+    main = soup.find("main") or soup.find("article") or soup.body or soup
+    text = url_loader._clean_text(main.get_text(separator="\n"))
+    soup = BeautifulSoup(html, "html.parser")
+    title = soup.title.string.strip() if soup.title and soup.title.string else None
+    links = [a.get("href") for a in soup.find_all("a", href=True)]
+    return text, title, links
+
+
+@contextlib.contextmanager
+def bs4_parser(name):
+    saved = url_loader.BS4_PARSER
+    url_loader.BS4_PARSER = name
+    try:
+        yield
+    finally:
+        url_loader.BS4_PARSER = saved
+
+
+def bs4_backend(name):
+    def parse(html):
+        with bs4_parser(name):
+            return url_loader._parse_html_bs4(html)
+    return parse
+
+
+def available_backends():
+    backends = {"html.parser x2 (до)": legacy_parse_html}
+    if url_loader.SelectolaxParser is not None:
+        backends["selectolax"] = url_loader._parse_html_selectolax
+    else:
+        print("[WARN] selectolax не установлен, бэкенд пропущен")
+    try:
+        import lxml  # noqa: F401
+        backends["bs4+lxml"] = bs4_backend("lxml")
+    except ImportError:
+        print("[WARN] lxml не установлен, бэкенд bs4+lxml пропущен")
+    backends["bs4+html.parser"] = bs4_backend("html.parser")
+    return backends
+
+
+def make_page(i, rng):
+    menu = "".join(f'<li><a href="/section/{k}">Раздел {k}</a></li>' for k in range(rng.randint(20, 60)))
+    paragraphs = "".join(
+        f"<p>{SENTENCE * rng.randint(1, 6)}<a href=\"/news/{i}/{k}\">подробнее</a></p>"
+        for k in range(rng.randint(20, 300))
+    )
+    rows = "".join(f"<tr><td>Аудитория {k}</td><td>{k % 9 + 1} этаж</td></tr>" for k in range(rng.randint(0, 80)))
+    return (f"<!DOCTYPE html><html><head><title>Страница {i}</title>"
+            f"<script>var counter = {i};</script><style>body {{ margin: 0 }}</style></head><body>"
+            f"<header><nav><ul>{menu}</ul></nav></header>"
+            f"<main><h1>Страница {i}</h1>{paragraphs}<table>{rows}</table>"
+            f"<form><input name=\"q\"></form></main>"
+            f"<aside>Новости</aside><footer>© Политех {i}</footer></body></html>")
+
+
+def load_corpus(corpus, pages):
+    if corpus:
+        files = sorted(p for p in Path(corpus).rglob("*") if p.suffix.lower() in (".html", ".htm"))
+        return [p.read_text(encoding="utf-8", errors="replace") for p in files]
+    rng = random.Random(42)
+    return [make_page(i, rng) for i in range(pages)]
+
+
+def measure(parse, corpus, repeat):
+    """Процессорное время разбора каждой страницы, мс (лучшее из repeat прогонов), и результаты"""
+    timings = []
+    results = []
+    for html in corpus:
+        best = None
+        for _ in range(repeat):
+            started = time.process_time()
+            result = parse(html)
+            elapsed = (time.process_time() - started) * 1000
+            best = elapsed if best is None else min(best, elapsed)
+        timings.append(best)
+        results.append(result)
+    return timings, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк разбора HTML по бэкендам")
+    parser.add_argument("--corpus", help="Каталог с сохранёнными страницами (*.html, *.htm)")
+    parser.add_argument("--pages", type=int, default=30, help="Страниц в синтетическом корпусе без --corpus")
+    parser.add_argument("--repeat", type=int, default=3, help="Прогонов каждой страницы, берётся лучший")
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.corpus, args.pages)
+    if not corpus:
+        print(f"[ERROR] В {args.corpus} нет страниц .html")
+        return
+    size_kb = sum(len(html.encode("utf-8")) for html in corpus) / len(corpus) / 1024
+    print(f"Страниц: {len(corpus)}, средний размер {size_kb:.0f} КБ, прогонов: {args.repeat}")
+
+    backends = available_backends()
+    rows = {name: measure(parse, corpus, args.repeat) for name, parse in backends.items()}
+    _, reference = rows["bs4+html.parser"]
+
+    print(f"\n{'бэкенд':<22} {'мс/стр':>8} {'медиана':>8} {'макс':>8} {'ускорение':>10} {'как html.parser':>16}")
+    baseline = statistics.mean(rows["html.parser x2 (до)"][0])
+    for name, (timings, results) in rows.items():
+        mean = statistics.mean(timings)
+        same = sum(result == ref for result, ref in zip(results, reference))
+        print(f"{name:<22} {mean:>8.2f} {statistics.median(timings):>8.2f} {max(timings):>8.2f} "
+              f"{baseline / mean:>9.1f}x {same:>8}/{len(corpus):<7}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Бенчмарк запросов к таблице напоминаний до и после индексов из reminders.MIGRATIONS.
+Заполняет временную базу (по умолчанию 1 млн строк), замеряет каждый запрос
+ReminderManager без индексов, применяет миграции и замеряет снова.
+
+    python -m scripts.bench_reminders --rows 1000000 --chats 50000
+"""
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import time
+from datetime import date, timedelta
+
+from reminders import MIGRATIONS
+
+SCHEMA = """
+    CREATE TABLE reminders (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id INTEGER NOT NULL,
+        reminder_text TEXT NOT NULL,
+        event_date DATE NOT NULL,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+"""
+
+# Запросы ReminderManager: имя -> (SQL, функция, выдающая параметры)
+QUERIES = {
+    "все напоминания чата": (
+        "SELECT id, reminder_text, event_date FROM reminders WHERE chat_id = ? ORDER BY event_date",
+        lambda ctx: (ctx.chat(),),
+    ),
+    "неделя чата": (
+        "SELECT id, reminder_text, event_date FROM reminders WHERE chat_id = ? AND event_date BETWEEN ? AND ? "
+        "ORDER BY event_date",
+        lambda ctx: (ctx.chat(), ctx.today.isoformat(), (ctx.today + timedelta(days=7)).isoformat()),
+    ),
+    "день чата": (
+        "SELECT id, reminder_text, event_date FROM reminders WHERE chat_id = ? AND event_date = ? ORDER BY event_date",
+        lambda ctx: (ctx.chat(), ctx.day()),
+    ),
+    "порция рассылки": (
+        "SELECT id, chat_id, reminder_text FROM reminders WHERE event_date = ? AND id > ? ORDER BY id LIMIT 500",
+        lambda ctx: (ctx.day(), 0),
+    ),
+    "удаление прошедших": (
+        "DELETE FROM reminders WHERE event_date < ?",
+        lambda ctx: (ctx.today.isoformat(),),
+    ),
+}
+
+
+class Context:
+    def __init__(self, chats, days, seed=0):
+        self.random = random.Random(seed)
+        self.chats = chats
+        self.days = days
+        self.today = date.today()
+
+    def chat(self):
+        return self.random.randrange(self.chats)
+
+    def day(self):
+        return (self.today + timedelta(days=self.random.randrange(self.days))).isoformat()
+
+
+def seed(db, rows, chats, days, past_days):
+    rng = random.Random(42)
+    today = date.today()
+    db.execute(SCHEMA)
+    db.executemany(
+        "INSERT INTO reminders (chat_id, reminder_text, event_date) VALUES (?, ?, ?)",
+        (
+            (rng.randrange(chats), f"Напоминание {i}", (today + timedelta(days=rng.randrange(-past_days, days))).isoformat())
+            for i in range(rows)
+        )
+    )
+    db.commit()
+
+
+def measure(db, sql, params_fn, ctx, repeats):
+    started = time.perf_counter()
+    for _ in range(repeats):
+        if sql.startswith("DELETE"):
+            # Удаление замеряем внутри транзакции и откатываем, чтобы данные не менялись
+            db.execute("BEGIN")
+            db.execute(sql, params_fn(ctx))
+            db.execute("ROLLBACK")
+        else:
+            db.execute(sql, params_fn(ctx)).fetchall()
+    return (time.perf_counter() - started) / repeats * 1000
+
+
+def plan(db, sql, params_fn, ctx):
+    rows = db.execute(f"EXPLAIN QUERY PLAN {sql}", params_fn(ctx)).fetchall()
+    return "; ".join(row[-1] for row in rows)
+
+
+def run_all(db, repeats, chats, days):
+    results = {}
+    for name, (sql, params_fn) in QUERIES.items():
+        ctx = Context(chats, days)
+        count = 3 if sql.startswith("DELETE") else repeats
+        results[name] = (measure(db, sql, params_fn, ctx, count), plan(db, sql, params_fn, ctx))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк индексов таблицы напоминаний")
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--chats", type=int, default=50_000)
+    parser.add_argument("--days", type=int, default=180, help="Даты событий на days дней вперёд")
+    parser.add_argument("--past-days", type=int, default=1,
+                        help="Сколько прошедших дней ещё не удалено (очистка идёт после каждой рассылки)")
+    parser.add_argument("--repeats", type=int, default=50)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = sqlite3.connect(os.path.join(tmp, "reminders.db"), isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL")
+        print(f"Заполнение {args.rows} строк...")
+        db.execute("BEGIN")
+        seed(db, args.rows, args.chats, args.days, args.past_days)
+
+        before = run_all(db, args.repeats, args.chats, args.days)
+        started = time.perf_counter()
+        for version in sorted(MIGRATIONS):
+            for statement in MIGRATIONS[version]:
+                db.execute(statement)
+        print(f"Миграции применены за {time.perf_counter() - started:.1f}s")
+        db.execute("ANALYZE")
+        after = run_all(db, args.repeats, args.chats, args.days)
+        db.close()
+
+    print(f"\n{'запрос':<22} {'без индексов, мс':>17} {'с индексами, мс':>16} {'ускорение':>10}")
+    for name in QUERIES:
+        old_ms, old_plan = before[name]
+        new_ms, new_plan = after[name]
+        print(f"{name:<22} {old_ms:17.2f} {new_ms:16.2f} {old_ms / max(new_ms, 1e-9):9.1f}x")
+        print(f"    до:    {old_plan}\n    после: {new_plan}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Бенчмарк стоп-последовательностей на заглушке OpenAI-совместимого сервера.
+Заглушка "генерирует" заранее заданный ответ модели на каждый вопрос с постоянной
+скоростью на токен и, как Ollama, прекращает генерацию на первой стоп-последовательности.
+Каждый вопрос задаётся с прежними параметрами (max_tokens=100, без stop) и с нынешними
+(QA_STOP_SEQUENCES, NAV_STOP_SEQUENCES и NAV_MAX_TOKENS); после обрезки ответы должны совпасть.
+
+    python -m scripts.bench_stop --token-ms 15 --prompt-ms 100
+"""
+import argparse
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from langchain_classic.chains import LLMChain
+from langchain_classic.prompts import PromptTemplate
+
+import scripts.model_init as model_init
+from scripts.rag import (PROMPT1, PROMPT2, QA_STOP_SEQUENCES, NAV_STOP_SEQUENCES, NAV_MAX_TOKENS,
+                         clean_answer, qa_ai_nav)
+
+LEGACY_MAX_TOKENS = 100
+CONTEXT = "Студенческий билет и пропуск выдаются в дирекции института. Библиотека находится в главном здании."
+# Продолжение, которое модель дописывает после ответа, пока не упрётся в max_tokens
+RAMBLE = ("\n\nВопрос студента: А где ещё можно узнать подробности?\nОтвет: Подробности можно узнать "
+          "на сайте университета и в дирекции института, где работают с 9 до 18 часов. ") * 6
+
+# Вопрос -> то, что модель генерирует в ответ на него
+QA_OUTPUTS = {
+    "Как получить студенческий билет?":
+        "Студенческий билет выдают в дирекции института. Нужна фотография 3х4. "
+        "Изготовление занимает неделю." + RAMBLE,
+    "Когда начинается зимняя сессия?":
+        "Информации недостаточно. Возможно, стоит уточнить расписание в деканате." + RAMBLE,
+    "Где находится библиотека?":
+        "Библиотека находится в главном здании. Вход со стороны двора. Работает с 9 до 18. . . . ."
+        " Окончательный ответ: библиотека в главном здании." + RAMBLE,
+    "Как заселиться в общежитие?":
+        "Заявление подаётся в студенческий офис.. Нужны паспорт и справка о зачислении." + RAMBLE,
+    "Как записаться в спортивную секцию?":
+        "Запись идёт через кафедру физкультуры в начале семестра. Выбрать секцию можно на сайте. "
+        "Занятия бесплатные для студентов.\n\nДата обращения: 01.09.2025." + RAMBLE,
+    "Какие бывают стипендии?":
+        "Стипендии бывают академические, социальные и повышенные: академическую получают студенты, "
+        "сдавшие сессию без троек, социальную назначают по справке из соцзащиты, повышенную дают за "
+        "достижения в учёбе, науке, спорте и общественной работе, а также существуют именные стипендии "
+        "правительства и президента, конкурс на которые проводится каждый год осенью и весной, причём "
+        "заявки принимают на кафедрах и в дирекции института вместе с портфолио достижений студента"
+        + RAMBLE,
+}
+NAV_OUTPUTS = {
+    "Как пройти в аудиторию 101 главного здания?":
+        "Можно увидеть на рисунке \"ГЗ\\101_.jpg\".\n\nПояснение: аудитория находится на первом этаже." + RAMBLE,
+    "Где аудитория 305 в первом учебном корпусе?":
+        "Можно увидеть на рисунке \"1 УК\\305_.jpg\".\n\nЕсли нужна другая аудитория, спросите ещё раз." + RAMBLE,
+}
+
+TOKEN_RE = re.compile(r"\s+|\w+|[^\w\s]")
+
+
+def generate(output, max_tokens, stop):
+    """Текст и число токенов, которые выдала бы модель с такими max_tokens и stop"""
+    text = ""
+    tokens = TOKEN_RE.findall(output)[:max_tokens]
+    for count, token in enumerate(tokens, 1):
+        text += token
+        hits = [text.find(s) for s in stop if s in text]
+        if hits:
+            return text[:min(hits)], count
+    return text, len(tokens)
+
+
+def make_handler(outputs, prompt_ms, token_ms, generated):
+    class StubOpenAI(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            prompt = body["messages"][-1]["content"]
+            output = next(out for question, out in outputs.items() if question in prompt)
+            max_tokens = body.get("max_completion_tokens") or body.get("max_tokens") or LEGACY_MAX_TOKENS
+            stop = body.get("stop") or []
+            text, count = generate(output, max_tokens, [stop] if isinstance(stop, str) else stop)
+            generated.append(count)
+            time.sleep((prompt_ms + token_ms * count) / 1000)
+            data = json.dumps({
+                "id": "bench", "object": "chat.completion", "created": int(time.time()), "model": body["model"],
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text},
+                             "finish_reason": "length" if count == max_tokens else "stop"}],
+                "usage": {"prompt_tokens": 0, "completion_tokens": count, "total_tokens": count},
+            }).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    return StubOpenAI
+
+
+def timed(generated, func, *args):
+    started = time.perf_counter()
+    answer = func(*args)
+    return answer, generated.pop(), (time.perf_counter() - started) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк стоп-последовательностей на заглушке LLM")
+    parser.add_argument("--token-ms", type=float, default=15, help="Время генерации одного токена")
+    parser.add_argument("--prompt-ms", type=float, default=100, help="Время обработки запроса до генерации")
+    args = parser.parse_args()
+
+    generated = []
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler({**QA_OUTPUTS, **NAV_OUTPUTS},
+                                                                args.prompt_ms, args.token_ms, generated))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    model_init.LM_API_URL = f"http://127.0.0.1:{server.server_port}/v1"
+    model_init.get_llm.cache_clear()
+
+    qa_before = model_init.get_llm(max_tokens=LEGACY_MAX_TOKENS)
+    qa_after = model_init.get_llm(stop=QA_STOP_SEQUENCES)
+    nav_prompt = PromptTemplate(input_variables=["question"], template=PROMPT2)
+    nav_before = LLMChain(llm=model_init.get_llm(max_tokens=LEGACY_MAX_TOKENS), prompt=nav_prompt)
+    nav_after = LLMChain(llm=model_init.get_llm(max_tokens=NAV_MAX_TOKENS, stop=NAV_STOP_SEQUENCES),
+                         prompt=nav_prompt)
+
+    def ask_qa(llm, question):
+        return clean_answer(llm.invoke(PROMPT1.format(context=CONTEXT, question=question)).content)[0]
+
+    rows = []
+    for question in QA_OUTPUTS:
+        rows.append((question, timed(generated, ask_qa, qa_before, question),
+                     timed(generated, ask_qa, qa_after, question)))
+    for question in NAV_OUTPUTS:
+        rows.append((question, timed(generated, qa_ai_nav, nav_before, question),
+                     timed(generated, qa_ai_nav, nav_after, question)))
+    server.shutdown()
+
+    print(f"\n{'вопрос':<46} {'токены до/после':>16} {'мс до/после':>16} {'ответ':>7}")
+    totals = [0, 0, 0.0, 0.0]
+    mismatches = 0
+    for question, (old_answer, old_tokens, old_ms), (new_answer, new_tokens, new_ms) in rows:
+        same = old_answer == new_answer
+        mismatches += not same
+        totals = [totals[0] + old_tokens, totals[1] + new_tokens, totals[2] + old_ms, totals[3] + new_ms]
+        print(f"{question:<46} {old_tokens:>7}/{new_tokens:<8} {old_ms:>7.0f}/{new_ms:<8.0f} "
+              f"{'тот же' if same else 'ДРУГОЙ':>7}")
+    print(f"{'итого':<46} {totals[0]:>7}/{totals[1]:<8} {totals[2]:>7.0f}/{totals[3]:<8.0f}")
+    print(f"\nСэкономлено токенов: {totals[0] - totals[1]} из {totals[0]} ({1 - totals[1] / totals[0]:.0%}), "
+          f"время ответа меньше на {1 - totals[3] / totals[2]:.0%}")
+    if mismatches:
+        print(f"[WARN] Ответов, изменившихся после обрезки: {mismatches}")
+
+
+if __name__ == "__main__":
+    main()
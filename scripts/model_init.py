@@ -13,7 +13,10 @@ from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_community.vectorstores import FAISS
 from concurrent.futures import ThreadPoolExecutor, as_completed
 import threading
+import sqlite3
+from functools import lru_cache
 import json
+import struct
 import time
 import numpy as np
 
@@ -27,28 +30,126 @@ LLM_MODEL_NAME = "qwen2.5:3b"
 EMBEDDING_MODEL_NAME = "all-minilm"
 FAISS_INDEX_NAME = "faiss_index"
 METADATA_NAME = "metadata.json"
+# Хеши чанков в базе: по строке (JSON-список) на каждое добавление, файл только дописывается
+CHUNK_MANIFEST_NAME = "chunk_hashes.jsonl"
 
 CHUNK_SIZE = 500
 CHUNK_OVERLAP = 50
 
 DEFAULT_BATCH_SIZE = 256
-DEFAULT_WORKERS = 4
+DEFAULT_WORKERS = int(os.environ.get("EMBED_WORKERS", 4))
+# Кэш эмбеддингов между пересборками базы (пустая строка - без кэша)
+EMBED_CACHE_PATH = os.environ.get("EMBED_CACHE_PATH", "embed_cache/embeddings.db")
+EMBED_BATCH_SIZE = 64  # максимум текстов в одном запросе к /api/embed
 faiss_lock = threading.Lock()
 
 
 class OllamaEmbeddings:
-    def __init__(self, model_name=EMBEDDING_MODEL_NAME, base_url=OLLAMA_BASE_URL, api_key=LM_API_KEY):
+    def __init__(self, model_name=EMBEDDING_MODEL_NAME, base_url=OLLAMA_BASE_URL, api_key=LM_API_KEY,
+                 embed_batch_size=EMBED_BATCH_SIZE):
         self.model_name = model_name
         self.base_url = base_url.rstrip("/")
         self.api_key = api_key
         self.session = requests.Session()
         self.session.headers.update({"Authorization": f"Bearer {api_key}", "User-Agent": USER_AGENT})
         self._timeout = 240
+        # Размер пачки для /api/embed подстраивается под ответы сервера
+        self.max_batch_size = embed_batch_size
+        self.embed_batch_size = embed_batch_size
+        # None - ещё не проверяли, поддерживает ли сервер /api/embed
+        self._batch_supported = None
+        # Размерность векторов модели, известна после первого успешного ответа
+        self._dimension = None
+        self._dimension_lock = threading.Lock()
 
     def embed_documents(self, texts):
+        """
+        Эмбеддинги для texts, выровненные по индексу. Для текстов, которые не удалось
+        обработать, на месте вектора стоит None: нулевые заглушки портили бы поиск.
+        """
         if isinstance(texts, str):
             texts = [texts]
-        
+
+        embeddings = None
+        if self._batch_supported is not False:
+            embeddings = self._embed_batched(texts)
+        if embeddings is None:
+            embeddings = self._embed_one_by_one(texts)
+        return [self._validate(emb) for emb in embeddings]
+
+    @property
+    def dimension(self):
+        """Размерность векторов модели: определяется одним пробным запросом и запоминается"""
+        if self._dimension is None:
+            self.embed_documents(["dimension probe"])
+            if self._dimension is None:
+                raise RuntimeError(f"Не удалось определить размерность эмбеддингов модели {self.model_name}")
+        return self._dimension
+
+    def _validate(self, embedding):
+        if not embedding:
+            return None
+        with self._dimension_lock:
+            if self._dimension is None:
+                self._dimension = len(embedding)
+                print(f"[INFO] Размерность эмбеддингов {self.model_name}: {self._dimension}")
+        if len(embedding) != self._dimension:
+            print(f"[WARN] Вектор размерности {len(embedding)} вместо {self._dimension} отброшен")
+            return None
+        # /api/embed отдаёт векторы единичной длины, а /api/embeddings - нет:
+        # приводим оба к одному виду, чтобы они были сравнимы в одном индексе
+        return l2_normalize(embedding)
+
+    def _embed_batched(self, texts):
+        """
+        Эмбеддинги через /api/embed, который принимает список текстов за один запрос.
+        При ошибке пачка делится пополам, при успехе размер постепенно растёт обратно.
+        Возвращает None, если сервер не поддерживает /api/embed.
+        """
+        embeddings = []
+        pos = 0
+        while pos < len(texts):
+            size = self.embed_batch_size
+            batch = texts[pos:pos + size]
+            try:
+                resp = self.session.post(
+                    f"{self.base_url}/api/embed",
+                    json={"model": self.model_name, "input": batch},
+                    timeout=self._timeout
+                )
+            except Exception as e:
+                print(f"[WARN] Ошибка пакетного эмбеддинга ({len(batch)} текстов): {e}")
+                resp = None
+
+            if resp is not None and resp.status_code == 404 and self._batch_supported is None:
+                print("[INFO] Сервер не поддерживает /api/embed, используем /api/embeddings")
+                self._batch_supported = False
+                return None
+
+            if resp is not None and resp.status_code == 200:
+                data = resp.json().get("embeddings", [])
+                if len(data) == len(batch):
+                    self._batch_supported = True
+                    embeddings.extend(data)
+                    pos += len(batch)
+                    if size < self.max_batch_size:
+                        self.embed_batch_size = min(size * 2, self.max_batch_size)
+                    continue
+                print(f"[WARN] /api/embed вернул {len(data)} векторов вместо {len(batch)}")
+            elif resp is not None:
+                print(f"[WARN] Ошибка пакетного эмбеддинга ({resp.status_code}): {resp.text}")
+
+            if size > 1:
+                self.embed_batch_size = max(size // 2, 1)
+                continue
+
+            # Даже одиночный текст не прошёл через /api/embed - пробуем старый эндпоинт
+            embeddings.extend(self._embed_one_by_one(batch))
+            pos += len(batch)
+
+        return embeddings
+
+    def _embed_one_by_one(self, texts):
         embeddings = []
         for text in texts:
             try:
@@ -62,32 +163,91 @@ class OllamaEmbeddings:
                     embeddings.append(data["embedding"])
                 else:
                     print(f"[WARN] Ошибка эмбеддинга ({resp.status_code}): {resp.text}")
-                    embeddings.append([0.0] * 768)  # fallback для nomic-embed-text
+                    embeddings.append(None)
             except Exception as e:
                 print(f"[ERROR] Ошибка при получении эмбеддинга: {e}")
-                embeddings.append([0.0] * 768)
+                embeddings.append(None)
         
         return embeddings
 
     def embed_query(self, text):
-        return self.embed_documents([text])[0]
+        embedding = self.embed_documents([text])[0]
+        if embedding is None:
+            raise RuntimeError("Не удалось получить эмбеддинг запроса")
+        return embedding
 
     def __call__(self, text):
         return self.embed_query(text)
 
 
+def l2_normalize(vector):
+    """Вектор единичной длины (список float) или None для нулевого вектора"""
+    v = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(v)
+    if not norm:
+        return None
+    return (v / norm).tolist()
+
+
+def normalize_faiss_index(db, tolerance=1e-3):
+    """
+    Приводит к единичной длине векторы базы, собранной из ненормированных эмбеддингов.
+    Порядок векторов не меняется, поэтому связь с docstore сохраняется.
+    Возвращает True, если индекс пришлось изменить.
+    """
+    index = db.index
+    if index.ntotal == 0:
+        return False
+    vectors = index.reconstruct_n(0, index.ntotal)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    # Нулевые векторы (заглушки старых версий) нормировать нечем, их пропускаем
+    if np.all((np.abs(norms - 1.0) < tolerance) | (norms == 0)):
+        return False
+    norms[norms == 0] = 1.0
+    index.reset()
+    index.add(np.ascontiguousarray(vectors / norms, dtype=np.float32))
+    print(f"[INFO] Векторы FAISS приведены к единичной длине ({index.ntotal} шт.)")
+    return True
+
+
+def migrate_faiss_normalization(kb_path, embedder):
+    """
+    Однократно нормирует векторы базы, собранной до нормировки эмбеддингов, и отмечает
+    в metadata.json, что база нормирована: дальше полный проход по векторам не нужен.
+    """
+    faiss_dir = get_faiss_path(kb_path)
+    metadata = load_metadata(kb_path)
+    if metadata.get("normalized") or not os.path.exists(faiss_dir):
+        return
+    try:
+        db = FAISS.load_local(faiss_dir, embedder, allow_dangerous_deserialization=True)
+    except Exception as e:
+        print(f"[WARN] Ошибка загрузки FAISS: {e}. Нормировка векторов отложена.")
+        return
+    if normalize_faiss_index(db):
+        db.save_local(faiss_dir)
+    metadata["normalized"] = True
+    save_metadata(kb_path, metadata)
+
+
 def get_embedder():
     return OllamaEmbeddings(EMBEDDING_MODEL_NAME, OLLAMA_BASE_URL, LM_API_KEY)
 
 
-def get_llm():
-    """Используем ChatOpenAI для совместимости с Ollama"""
+@lru_cache(maxsize=None)
+def get_llm(model_name=LLM_MODEL_NAME, temperature=0.5, max_tokens=100, stop=None):
+    """
+    Используем ChatOpenAI для совместимости с Ollama.
+    Клиент создаётся один раз на набор параметров и переиспользует HTTP-соединения.
+    stop - кортеж стоп-последовательностей, на которых модель прекращает генерацию.
+    """
     return ChatOpenAI(
         openai_api_base=LM_API_URL,
         openai_api_key=LM_API_KEY,
-        model_name=LLM_MODEL_NAME,
-        temperature=0.5,
-        max_tokens=100,
+        model_name=model_name,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        stop=list(stop) if stop else None,
         streaming=False
     )
 
@@ -100,68 +260,274 @@ def get_metadata_path(kb_path):
     return os.path.join(kb_path, METADATA_NAME)
 
 
-class _PrecomputedEmbeddings:
+def chunk_hash(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def get_chunk_manifest_path(kb_path):
+    return os.path.join(kb_path, CHUNK_MANIFEST_NAME)
+
+
+def load_metadata(kb_path):
+    """Сведения о базе из metadata.json или пустой словарь"""
+    path = get_metadata_path(kb_path)
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"[WARN] Не удалось прочитать {path}: {e}")
+        return {}
+
+
+def save_metadata(kb_path, metadata):
+    path = get_metadata_path(kb_path)
+    tmp_path = path + ".tmp"
+    os.makedirs(kb_path, exist_ok=True)
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(metadata, f)
+    os.replace(tmp_path, path)
+
+
+def load_chunk_manifest(kb_path, default=None):
+    """
+    Хеши чанков, уже лежащих в FAISS, из chunk_hashes.jsonl рядом с индексом.
+    Манифест старого формата (список в metadata.json) переносится в jsonl один раз.
+    Возвращает default, если манифеста нет или он не соответствует индексу.
     """
-    Объект в стиле LangChain Embeddings, который возвращает заранее вычисленные векторы.
+    path = get_chunk_manifest_path(kb_path)
+    if not os.path.exists(get_faiss_path(kb_path)):
+        return default
+    if not os.path.exists(path):
+        metadata = load_metadata(kb_path)
+        if "chunk_hashes" not in metadata:
+            return default
+        hashes = set(metadata.pop("chunk_hashes"))
+        save_chunk_manifest(kb_path, hashes)
+        save_metadata(kb_path, metadata)
+        return hashes
+
+    hashes = set()
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    hashes.update(json.loads(line))
+                except ValueError:
+                    # Недописанная строка после сбоя: эти чанки просто посчитаются заново
+                    print(f"[WARN] Пропущена повреждённая строка манифеста {path}")
+    except OSError as e:
+        print(f"[WARN] Не удалось прочитать манифест {path}: {e}")
+        return default
+    return hashes
+
+
+def save_chunk_manifest(kb_path, hashes):
+    """Записывает манифест заново - для новой базы или базы без манифеста"""
+    path = get_chunk_manifest_path(kb_path)
+    tmp_path = path + ".tmp"
+    os.makedirs(kb_path, exist_ok=True)
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(json.dumps(sorted(hashes)) + "\n")
+    os.replace(tmp_path, path)
+
+
+def append_chunk_manifest(kb_path, hashes):
+    """Дописывает хеши добавленных чанков одной строкой, не перечитывая манифест"""
+    with open(get_chunk_manifest_path(kb_path), "a+b") as f:
+        # Недописанную после сбоя строку закрываем, чтобы не испортить новую
+        if f.tell():
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                f.write(b"\n")
+        f.write((json.dumps(list(hashes)) + "\n").encode("utf-8"))
+
+
+def faiss_index_dimension(faiss_dir):
     """
-    def __init__(self, text_to_embedding_map):
-        self.text_to_embedding_map = text_to_embedding_map
+    Размерность векторов сохранённой базы или None, если индекса нет.
+    Читается из заголовка index.faiss (fourcc, затем int32 d), сами векторы не загружаются.
+    """
+    index_file = os.path.join(faiss_dir, "index.faiss")
+    if not os.path.exists(index_file):
+        return None
+    with open(index_file, "rb") as f:
+        header = f.read(8)
+    if len(header) < 8:
+        raise ValueError(f"Повреждён заголовок {index_file}")
+    return struct.unpack("<i", header[4:8])[0]
+
+
+def rebuild_chunk_manifest(kb_path, embedder):
+    """Однократно строит манифест по docstore базы, созданной до появления metadata.json"""
+    faiss_dir = get_faiss_path(kb_path)
+    hashes = set()
+    if not os.path.exists(faiss_dir):
+        return hashes
+    try:
+        db = FAISS.load_local(faiss_dir, embedder, allow_dangerous_deserialization=True)
+        if hasattr(db, 'docstore') and hasattr(db.docstore, '_dict'):
+            for doc in db.docstore._dict.values():
+                if hasattr(doc, 'page_content'):
+                    hashes.add(chunk_hash(doc.page_content))
+        save_chunk_manifest(kb_path, hashes)
+        print(f"[INFO] Манифест чанков построен по существующей базе: {len(hashes)} чанков.")
+    except Exception as e:
+        print(f"[WARN] Ошибка загрузки FAISS: {e}. Манифест не построен.")
+    return hashes
+
+
+class EmbeddingCache:
+    """
+    Постоянный кэш эмбеддингов в SQLite: (модель, SHA-1 текста) -> вектор float32.
+    Переживает пересборку FAISS с нуля, так что платить приходится только за новые чанки.
+    """
+    LOOKUP_CHUNK = 500
+
+    def __init__(self, path=EMBED_CACHE_PATH):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "model TEXT NOT NULL, hash TEXT NOT NULL, vector BLOB NOT NULL, "
+            "PRIMARY KEY (model, hash))"
+        )
+        self.db.commit()
+
+    def get_many(self, model, hashes):
+        """hash -> вектор для всех найденных в кэше хешей"""
+        found = {}
+        unique = list(set(hashes))
+        with self._lock:
+            for i in range(0, len(unique), self.LOOKUP_CHUNK):
+                part = unique[i:i + self.LOOKUP_CHUNK]
+                rows = self.db.execute(
+                    f"SELECT hash, vector FROM embeddings WHERE model = ? AND hash IN ({','.join('?' * len(part))})",
+                    [model, *part]
+                ).fetchall()
+                for h, blob in rows:
+                    # Записи до нормализации эмбеддингов могли остаться ненормированными
+                    vector = l2_normalize(np.frombuffer(blob, dtype=np.float32))
+                    if vector is not None:
+                        found[h] = vector
+        return found
+
+    def put_many(self, model, items):
+        """items - пары (hash, вектор)"""
+        with self._lock:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, hash, vector) VALUES (?, ?, ?)",
+                [(model, h, np.asarray(v, dtype=np.float32).tobytes()) for h, v in items]
+            )
+            self.db.commit()
 
-    def embed_documents(self, texts):
-        embeddings = []
-        for text in texts:
-            embedding = self.text_to_embedding_map.get(text)
-            if embedding is None:
-                raise ValueError(f"Embedding not found for text: {text[:100]}...")
-            embeddings.append(embedding)
-        return embeddings
+    def close(self):
+        with self._lock:
+            self.db.close()
 
-    def embed_query(self, text):
-        return self.text_to_embedding_map.get(text)
-    
-    def __call__(self, text):
-        """Для совместимости с FAISS"""
-        return self.embed_query(text)
+
+def embed_in_batches(texts, embedder, batch_size=DEFAULT_BATCH_SIZE, workers=DEFAULT_WORKERS,
+                     retries=2, retry_delay=5):
+    """
+    Эмбеддинги для texts пачками в пуле из workers потоков.
+    Тексты, для которых эмбеддинг не получен, собираются в очередь повторов и
+    отправляются ещё до retries раз с паузой retry_delay секунд.
+    Возвращает (эмбеддинги, отчёт): список выровнен с texts по индексу, для
+    необработанных текстов в нём None; отчёт - счётчики embedded, retried, failed.
+    """
+    results = [None] * len(texts)
+    retried = set()
+
+    def process_batch(indices):
+        try:
+            embeddings = embedder.embed_documents([texts[i] for i in indices])
+        except Exception as e:
+            print(f"[ERROR] Ошибка при вычислении эмбеддингов ({len(indices)} текстов): {e}")
+            return indices, [None] * len(indices)
+        if embeddings is None or len(embeddings) != len(indices):
+            print("[ERROR] Получено неверное число эмбеддингов")
+            return indices, [None] * len(indices)
+        return indices, embeddings
+
+    pending = list(range(len(texts)))
+    for attempt in range(retries + 1):
+        if not pending:
+            break
+        if attempt:
+            print(f"[INFO] Повторная обработка {len(pending)} текстов (попытка {attempt} из {retries})...")
+            retried.update(pending)
+            time.sleep(retry_delay)
+        batches = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(process_batch, batch) for batch in batches]
+            for future in tqdm(as_completed(futures), total=len(futures), desc="Вычисление эмбеддингов"):
+                indices, embeddings = future.result()
+                for i, emb in zip(indices, embeddings):
+                    results[i] = emb
+        pending = [i for i in pending if results[i] is None]
+
+    report = {
+        "embedded": len(texts) - len(pending),
+        "retried": len(retried),
+        "failed": len(pending),
+    }
+    print(f"[INFO] Эмбеддинги: получено {report['embedded']}, повторно отправлено {report['retried']}, "
+          f"не удалось {report['failed']}")
+    return results, report
 
 
 def add_chunks_to_faiss(
-    items: dict,
+    items,
     output_dir: str,
     embedder: OllamaEmbeddings,  # ИСПРАВЛЕНО: OllamaEmbeddings вместо LMStudioEmbeddings
     min_text_len: int = 50,
     batch_size: int = DEFAULT_BATCH_SIZE,
     workers: int = DEFAULT_WORKERS,
+    cache_path: str = EMBED_CACHE_PATH,
+    indexed_sources: set = None,
 ):
     """
     Оптимизированная функция для добавления чанков в FAISS.
+    items - словарь {источник: {"text", "title"}} или итератор таких пар: тексты
+    режутся на чанки по мере поступления, не дожидаясь остальных.
+    Уже добавленные чанки определяются по манифесту хешей (chunk_hashes.jsonl),
+    эмбеддинги считаются только для новых. Возвращает обновлённую базу или None,
+    если добавлять было нечего. Векторы, посчитанные раньше, берутся из кэша cache_path.
+    В indexed_sources добавляются источники, все чанки которых после вызова есть в базе:
+    источник, часть чанков которого не удалось добавить, туда не попадает.
     """
     splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
     faiss_dir = get_faiss_path(output_dir)
 
     with faiss_lock:
-        existing_hashes = set()
-        db = None
-        if os.path.exists(faiss_dir):
-            try:
-                db = FAISS.load_local(faiss_dir, embedder, allow_dangerous_deserialization=True)
-                # Быстрое получение хешей из метаданных
-                if hasattr(db, 'docstore') and hasattr(db.docstore, '_dict'):
-                    for doc_id, doc in db.docstore._dict.items():
-                        if hasattr(doc, 'page_content'):
-                            text = doc.page_content
-                            existing_hashes.add(hashlib.sha1(text.encode("utf-8")).hexdigest())
-                print(f"[INFO] Загружена существующая FAISS база с {len(existing_hashes)} чанками.")
-            except Exception as e:
-                print(f"[WARN] Ошибка загрузки FAISS: {e}. Создаём новую базу.")
-                db = None
+        existing_hashes = load_chunk_manifest(output_dir)
+        if existing_hashes is None:
+            existing_hashes = rebuild_chunk_manifest(output_dir, embedder)
+        else:
+            print(f"[INFO] Манифест чанков загружен: {len(existing_hashes)} чанков в базе.")
+        migrate_faiss_normalization(output_dir, embedder)
+    known_hashes = set(existing_hashes)
+    # источник -> хеши всех его чанков, включая уже известные
+    source_hashes = {}
+
+    def report_indexed(hashes_in_base):
+        if indexed_sources is not None:
+            indexed_sources.update(src for src, uids in source_hashes.items() if uids <= hashes_in_base)
 
     all_chunks = []
     all_metadatas = []
+    new_hashes = []
     
     print("[INFO] Подготовка чанков...")
-    for source, data in tqdm(items.items(), desc="Обработка источников"):
+    pairs = items.items() if isinstance(items, dict) else items
+    for source, data in tqdm(pairs, desc="Обработка источников"):
         text = data.get("text", "")
         title = data.get("title", source)
+        uids = source_hashes.setdefault(source, set())
         
         if not text or len(text.strip()) < min_text_len:
             continue
@@ -172,11 +538,14 @@ def add_chunks_to_faiss(
             if len(chunk) < min_text_len:
                 continue
                 
-            uid = hashlib.sha1(chunk.encode("utf-8")).hexdigest()
+            uid = chunk_hash(chunk)
+            uids.add(uid)
             if uid in existing_hashes:
                 continue
+            existing_hashes.add(uid)
                 
             all_chunks.append(chunk)
+            new_hashes.append(uid)
             all_metadatas.append({
                 "source": source,
                 "title": f"{title} (chunk {i})",
@@ -186,94 +555,111 @@ def add_chunks_to_faiss(
 
     if not all_chunks:
         print("[INFO] Нет новых чанков для добавления.")
-        return db
+        report_indexed(known_hashes)
+        return None
 
     total_chunks = len(all_chunks)
     print(f"[INFO] Будет обработано {total_chunks} новых чанков")
 
     # 3. Параллельное вычисление эмбеддингов
     print(f"[INFO] Вычисление эмбеддингов (batch_size={batch_size}, workers={workers})...")
-
-
-    def process_batch(batch_texts):
-        try:
-            return embedder.embed_documents(batch_texts)
-        except Exception as e:
-            print(f"[ERROR] Ошибка при вычислении эмбеддингов: {e}")
-            return None
-
-    text_batches = [all_chunks[i:i + batch_size] for i in range(0, total_chunks, batch_size)]
-    all_embeddings = []
-    failed_batches = []
-
     start_time = time.time()
-    
-    with ThreadPoolExecutor(max_workers=workers) as executor:
-        future_to_batch = {executor.submit(process_batch, batch): idx 
-                          for idx, batch in enumerate(text_batches)}
-        
-        for future in tqdm(as_completed(future_to_batch), total=len(future_to_batch), desc="Вычисление эмбеддингов"):
-            batch_idx = future_to_batch[future]
-            try:
-                embeddings = future.result()
-                if embeddings is not None:
-                    all_embeddings.extend(embeddings)
-                else:
-                    failed_batches.append(batch_idx)
-            except Exception as e:
-                print(f"[ERROR] Ошибка в потоке: {e}")
-                failed_batches.append(batch_idx)
-
-    if failed_batches:
-        print(f"[INFO] Повторная обработка {len(failed_batches)} батчей...")
-        for batch_idx in failed_batches:
-            try:
-                batch_texts = text_batches[batch_idx]
-                embeddings = process_batch(batch_texts)
-                if embeddings is not None:
-                    all_embeddings.extend(embeddings)
-                else:
-                    print(f"[WARN] Не удалось обработать батч {batch_idx}")
-            except Exception as e:
-                print(f"[ERROR] Повторная ошибка для батча {batch_idx}: {e}")
-
+    embeddings = [None] * total_chunks
+    cache = EmbeddingCache(cache_path) if cache_path else None
+    model_name = getattr(embedder, "model_name", type(embedder).__name__)
+    if cache is not None:
+        cached = cache.get_many(model_name, new_hashes)
+        embeddings = [cached.get(h) for h in new_hashes]
+        print(f"[INFO] Из кэша эмбеддингов взято {len(cached)} из {total_chunks} чанков")
+
+    # Базу другой размерности всё равно не дополнить - проверяем до того, как считать эмбеддинги.
+    # Размерность берётся из вектора из кэша, пробный запрос к модели - только если кэш пуст
+    dimension_error = None
+    try:
+        base_dimension = faiss_index_dimension(faiss_dir)
+        if base_dimension is not None:
+            cached_vector = next((emb for emb in embeddings if emb is not None), None)
+            if cached_vector is not None:
+                model_dimension = len(cached_vector)
+            elif isinstance(embedder, OllamaEmbeddings):
+                model_dimension = embedder.dimension
+            else:
+                model_dimension = None
+            if model_dimension is not None and model_dimension != base_dimension:
+                dimension_error = (f"Размерность базы ({base_dimension}) не совпадает с размерностью модели "
+                                   f"{model_name} ({model_dimension}). Пересоберите базу с нуля.")
+    except Exception as e:
+        dimension_error = f"Не удалось проверить размерность эмбеддингов: {e}."
+    if dimension_error:
+        print(f"[ERROR] {dimension_error} Новые чанки не сохранены.")
+        if cache is not None:
+            cache.close()
+        report_indexed(known_hashes)
+        return None
+
+    missing = [i for i, emb in enumerate(embeddings) if emb is None]
+    if missing:
+        computed, _ = embed_in_batches([all_chunks[i] for i in missing], embedder, batch_size, workers)
+        for i, emb in zip(missing, computed):
+            embeddings[i] = emb
+        if cache is not None:
+            cache.put_many(model_name, [(new_hashes[i], emb) for i, emb in zip(missing, computed) if emb is not None])
+    if cache is not None:
+        cache.close()
     elapsed = time.time() - start_time
     print(f"[INFO] Эмбеддинги рассчитаны за {elapsed:.1f}s")
 
-    # 4. Добавление в FAISS
+    # Чанки без эмбеддинга выбрасываются вместе с метаданными, чтобы не сбить соответствие
+    kept = [i for i, emb in enumerate(embeddings) if emb is not None]
+    if len(kept) < total_chunks:
+        print(f"[WARN] Пропущено {total_chunks - len(kept)} чанков без эмбеддингов")
+    if not kept:
+        report_indexed(known_hashes)
+        return None
+    all_chunks = [all_chunks[i] for i in kept]
+    all_metadatas = [all_metadatas[i] for i in kept]
+    new_hashes = [new_hashes[i] for i in kept]
+    all_embeddings = [embeddings[i] for i in kept]
+    total_chunks = len(kept)
+
+    # 4. Добавление в FAISS: новые векторы собираются в отдельный индекс и вливаются в базу
     with faiss_lock:
-        if db is None:
-            print("[INFO] Создание новой FAISS базы...")
-            db = FAISS.from_embeddings(
-                text_embeddings=list(zip(all_chunks, all_embeddings)),
-                embedding=embedder,
-                metadatas=all_metadatas
-            )
-        else:
-            # Добавляем в существующую базу
+        new_db = FAISS.from_embeddings(
+            text_embeddings=list(zip(all_chunks, all_embeddings)),
+            embedding=embedder,
+            metadatas=all_metadatas
+        )
+
+        base_exists = os.path.exists(faiss_dir)
+        if base_exists:
             print("[INFO] Добавление в существующую FAISS базу...")
-            
-            text_to_embedding = dict(zip(all_chunks, all_embeddings))
-            temp_embeddings = _PrecomputedEmbeddings(text_to_embedding)
-            
-            original_embedding_function = getattr(db, 'embedding_function', None)
-            original_embedding_function_private = getattr(db, '_embedding_function', None)
-            
-            if hasattr(db, 'embedding_function'):
-                db.embedding_function = temp_embeddings
-            if hasattr(db, '_embedding_function'):
-                db._embedding_function = temp_embeddings
-            
             try:
-                db.add_texts(all_chunks, metadatas=all_metadatas)
-            finally:
-                if original_embedding_function is not None:
-                    db.embedding_function = original_embedding_function
-                if original_embedding_function_private is not None:
-                    db._embedding_function = original_embedding_function_private
+                db = FAISS.load_local(faiss_dir, embedder, allow_dangerous_deserialization=True)
+            except Exception as e:
+                # Не перезаписываем базу, которую не смогли прочитать
+                print(f"[ERROR] Ошибка загрузки FAISS: {e}. Новые чанки не сохранены.")
+                report_indexed(known_hashes)
+                return None
+            if db.index.d != new_db.index.d:
+                print(f"[ERROR] Размерность базы ({db.index.d}) не совпадает с размерностью модели "
+                      f"({new_db.index.d}). Пересоберите базу с нуля. Новые чанки не сохранены.")
+                report_indexed(known_hashes)
+                return None
+            db.merge_from(new_db)
+        else:
+            print("[INFO] Создание новой FAISS базы...")
+            db = new_db
 
         os.makedirs(faiss_dir, exist_ok=True)
         db.save_local(faiss_dir)
+        if base_exists:
+            append_chunk_manifest(output_dir, new_hashes)
+        else:
+            save_chunk_manifest(output_dir, new_hashes)
+            # Новая база собрана только из нормированных векторов
+            save_metadata(output_dir, {**load_metadata(output_dir), "normalized": True})
+        hashes_in_base = known_hashes | set(new_hashes)
+        report_indexed(hashes_in_base)
         print(f"[OK] FAISS сохранён в {faiss_dir} ({total_chunks} новых чанков)")
 
     return db
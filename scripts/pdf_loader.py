@@ -1,40 +1,82 @@
 # -*- coding: utf-8 -*-
+import io
+import multiprocessing
+import os
+import queue
+import time
 from pathlib import Path
 import requests
 import pdfplumber
-from typing import List
-from scripts.model_init import add_chunks_to_faiss
+from tqdm import tqdm
+from typing import Iterable, Iterator, List, Tuple
+from scripts.model_init import add_chunks_to_faiss, USER_AGENT
 
 CHUNK_SIZE = 500
 CHUNK_OVERLAP = 50
 
-def extract_text_from_pdf_file(path: Path) -> str:
+# Ограничения для PDF: больше скачивать и разбирать не стоит
+MAX_PDF_BYTES = int(os.environ.get("MAX_PDF_MB", 50)) * 1024 * 1024
+MAX_PDF_PAGES = int(os.environ.get("MAX_PDF_PAGES", 500))
+PDF_TIMEOUT = 20
+DOWNLOAD_CHUNK = 64 * 1024
+
+# Параллельный разбор локальных PDF
+PDF_WORKERS = int(os.environ.get("PDF_WORKERS", os.cpu_count() or 1))
+PDF_TASK_TIMEOUT = int(os.environ.get("PDF_TASK_TIMEOUT", 300))  # секунд на файл или часть большого файла
+LARGE_PDF_PAGES = 100      # файлы длиннее разбираются частями в нескольких процессах
+PAGES_PER_TASK = 25
+
+def _pages_text(pdf, start: int, stop: int) -> str:
     texts = []
+    for p in pdf.pages[start:stop]:
+        t = p.extract_text()
+        if t:
+            texts.append(t)
+        # Кэш разобранных объектов страницы больше не нужен
+        p.close()
+    return "\n\n".join(texts)
+
+def _extract_pages_text(source, name: str, max_pages: int = MAX_PDF_PAGES) -> str:
+    """Текст первых max_pages страниц PDF; source - путь или файлоподобный объект"""
+    with pdfplumber.open(source) as pdf:
+        if len(pdf.pages) > max_pages:
+            print(f"[WARN] {name}: {len(pdf.pages)} страниц, берём первые {max_pages}")
+        return _pages_text(pdf, 0, max_pages)
+
+def extract_text_from_pdf_file(path: Path) -> str:
     try:
-        with pdfplumber.open(path) as pdf:
-            for p in pdf.pages:
-                t = p.extract_text()
-                if t:
-                    texts.append(t)
+        return _extract_pages_text(path, str(path))
     except Exception as e:
         print(f"[ERROR] Failed to read {path}: {e}")
-    return "\n\n".join(texts)
+        return ""
 
-def extract_text_from_pdf_url(url: str) -> str:
-    import io
+def extract_text_from_pdf_bytes(data: bytes, source: str = "<bytes>") -> str:
+    """PDF целиком в памяти, без временных файлов на диске"""
     try:
-        resp = requests.get(url)
-        resp.raise_for_status()
-        with pdfplumber.open(io.BytesIO(resp.content)) as pdf:
-            texts = []
-            for p in pdf.pages:
-                t = p.extract_text()
-                if t:
-                    texts.append(t)
-            return "\n\n".join(texts)
+        return _extract_pages_text(io.BytesIO(data), source)
+    except Exception as e:
+        print(f"[ERROR] Failed to read PDF {source}: {e}")
+        return ""
+
+def check_pdf_size(size, url: str, max_bytes: int = MAX_PDF_BYTES):
+    """Бросает ValueError, если PDF (по Content-Length или уже скачанной части) больше max_bytes"""
+    if size is not None and int(size) > max_bytes:
+        raise ValueError(f"PDF {url} больше {max_bytes // (1024 * 1024)} МБ")
+
+def extract_text_from_pdf_url(url: str, max_bytes: int = MAX_PDF_BYTES) -> str:
+    """Скачивает PDF потоком в память, обрывая загрузку на max_bytes, и разбирает из буфера"""
+    buffer = io.BytesIO()
+    try:
+        with requests.get(url, headers={"User-Agent": USER_AGENT}, timeout=PDF_TIMEOUT, stream=True) as resp:
+            resp.raise_for_status()
+            check_pdf_size(resp.headers.get("Content-Length"), url, max_bytes)
+            for chunk in resp.iter_content(DOWNLOAD_CHUNK):
+                buffer.write(chunk)
+                check_pdf_size(buffer.tell(), url, max_bytes)
     except Exception as e:
         print(f"[ERROR] Failed to fetch PDF from {url}: {e}")
         return ""
+    return extract_text_from_pdf_bytes(buffer.getvalue(), url)
 
 def chunk_text(text: str, chunk_size: int = 500, overlap: int = 50) -> List[str]:
     chunks = []
@@ -52,20 +94,144 @@ def chunk_text(text: str, chunk_size: int = 500, overlap: int = 50) -> List[str]
 
 
     
-def add_pdfs_to_faiss_main(pdf_dir: str, output_dir: str, embedder):
+def _pdf_task(path: str, start: int = 0, stop: int = None):
     """
-    Главная функция для добавления PDF из локальной папки в FAISS.
+    Задача для процесса пула. Без stop разбирает файл целиком, если он небольшой,
+    а для большого возвращает только число страниц, чтобы разбить его на части.
     """
+    try:
+        with pdfplumber.open(path) as pdf:
+            n_pages = len(pdf.pages)
+            if n_pages > MAX_PDF_PAGES:
+                print(f"[WARN] {path}: {n_pages} страниц, берём первые {MAX_PDF_PAGES}")
+                n_pages = MAX_PDF_PAGES
+            if stop is None:
+                if n_pages > LARGE_PDF_PAGES:
+                    return "split", n_pages
+                stop = n_pages
+            return "text", _pages_text(pdf, start, stop)
+    except Exception as e:
+        return "error", str(e)
 
-    pdf_dir = Path(pdf_dir)
-    items = {}
-    for f in pdf_dir.rglob("*.pdf"):
-        text = extract_text_from_pdf_file(f)
+def iter_pdf_texts(paths: List[Path], workers: int = PDF_WORKERS,
+                   timeout: float = PDF_TASK_TIMEOUT) -> Iterator[Tuple[Path, str]]:
+    """
+    Разбирает PDF в пуле из workers процессов и отдаёт (путь, текст) по мере готовности,
+    в произвольном порядке. Большие файлы делятся на части по PAGES_PER_TASK страниц.
+    Файл, часть которого не уложилась в timeout секунд или упала с ошибкой, пропускается.
+    """
+    if workers <= 1:
+        for path in tqdm(paths, desc="Разбор PDF"):
+            yield path, extract_text_from_pdf_file(path)
+        return
+
+    done = queue.Queue()
+    pending = [(path, 0, None) for path in paths]   # задачи, ещё не отправленные в пул
+    running = {}                                     # id задачи -> (путь, начало части, конец части, срок)
+    parts = {}                                       # путь -> {начало части: текст}
+    expected = {}                                    # путь -> сколько частей ждём
+    failed = set()
+    task_id = 0
+
+    pool = multiprocessing.Pool(workers)
+    progress = tqdm(total=len(paths), desc="Разбор PDF")
+
+    def mark_failed(path):
+        # Оставшиеся части файла больше не нужны ни в очереди, ни в сборке
+        failed.add(path)
+        pending[:] = [task for task in pending if task[0] != path]
+        parts.pop(path, None)
+        progress.update(1)
+
+    try:
+        while pending or running:
+            # В пуле не больше workers задач: так срок отсчитывается от фактического начала разбора
+            while pending and len(running) < workers:
+                # С конца списка: части уже начатого большого файла идут первыми
+                path, start, stop = pending.pop()
+                if path in failed:
+                    continue
+                task_id += 1
+                running[task_id] = (path, start, stop, time.monotonic() + timeout)
+                pool.apply_async(
+                    _pdf_task, (str(path), start, stop),
+                    callback=lambda result, tid=task_id: done.put((tid, result)),
+                    error_callback=lambda e, tid=task_id: done.put((tid, ("error", str(e)))),
+                )
+            if not running:
+                continue
+
+            wait = max(0.0, min(task[3] for task in running.values()) - time.monotonic())
+            try:
+                tid, (kind, value) = done.get(timeout=wait)
+            except queue.Empty:
+                now = time.monotonic()
+                for path, start, stop, deadline in running.values():
+                    if deadline <= now and path not in failed:
+                        print(f"[WARN] {path}: разбор не уложился в {timeout} с, файл пропущен")
+                        mark_failed(path)
+                # Зависший процесс из пула не снять, поэтому пул пересоздаётся,
+                # а успевшие начаться задачи других файлов отправляются заново
+                pending.extend((path, start, stop) for path, start, stop, _ in running.values() if path not in failed)
+                running.clear()
+                pool.terminate()
+                pool.join()
+                pool = multiprocessing.Pool(workers)
+                continue
+
+            if tid not in running:
+                continue  # результат задачи из пересозданного пула
+            path, start, _, _ = running.pop(tid)
+            if path in failed:
+                continue
+            if kind == "split":
+                # Большой файл: разбираем части параллельно
+                expected[path] = 0
+                for part_start in range(0, value, PAGES_PER_TASK):
+                    pending.append((path, part_start, min(part_start + PAGES_PER_TASK, value)))
+                    expected[path] += 1
+                parts[path] = {}
+                continue
+            if kind == "error":
+                print(f"[ERROR] Failed to read {path}: {value}")
+                mark_failed(path)
+                continue
+
+            if path not in expected:
+                progress.update(1)
+                yield path, value
+                continue
+            parts[path][start] = value
+            if len(parts[path]) == expected[path]:
+                file_parts = parts.pop(path)
+                progress.update(1)
+                yield path, "\n\n".join(file_parts[k] for k in sorted(file_parts) if file_parts[k])
+    finally:
+        progress.close()
+        # terminate, а не close: зависшие процессы иначе не дали бы завершиться
+        pool.terminate()
+        pool.join()
+
+def pdf_items(paths: List[Path], workers: int = PDF_WORKERS, found: list = None) -> Iterable[Tuple[str, dict]]:
+    """
+    Пары (источник, {"text", "title"}) для add_chunks_to_faiss прямо по мере разбора,
+    без словаря со всеми текстами в памяти. В found добавляются источники с непустым текстом.
+    """
+    for path, text in iter_pdf_texts(paths, workers):
         if text.strip():
-            items[str(f.resolve())] = {"text": text, "title": f.stem}
+            source = str(Path(path).resolve())
+            if found is not None:
+                found.append(source)
+            yield source, {"text": text, "title": Path(path).stem}
+    
+def add_pdfs_to_faiss_main(pdf_dir: str, output_dir: str, embedder, workers: int = PDF_WORKERS):
+    """
+    Главная функция для добавления PDF из локальной папки в FAISS.
+    """
 
-    if not items:
+    paths = sorted(Path(pdf_dir).rglob("*.pdf"))
+    if not paths:
         print("[INFO] PDF файлов для добавления не найдено.")
         return
 
-    add_chunks_to_faiss(items, output_dir, embedder)
\ No newline at end of file
+    add_chunks_to_faiss(pdf_items(paths, workers), output_dir, embedder)
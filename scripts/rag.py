@@ -7,13 +7,29 @@ from langchain_classic.prompts import PromptTemplate
 from langchain_community.vectorstores import FAISS
 from langchain_classic.schema import BaseRetriever
 
-from scripts.model_init import get_llm, get_faiss_path
+from scripts.model_init import get_llm, get_faiss_path, load_metadata, normalize_faiss_index, LLM_MODEL_NAME
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+import asyncio
+import os
 import re
 
 DEFAULT_KB_PATH = "kb_output"
 DEFAULT_TOP_K = 3
 
+# Сколько генераций Ollama выполняется одновременно и сколько ждём одну
+LLM_CONCURRENCY = int(os.environ.get("LLM_CONCURRENCY", 2))
+LLM_TIMEOUT = float(os.environ.get("LLM_TIMEOUT", 60))
+
+KEY_PHRASE = "Информации недостаточно"
+# Правила обрезки из clean_answer, перенесённые в запрос к модели:
+# всё после этих последовательностей бот всё равно выбрасывает, поэтому и генерировать их незачем.
+# ".." и ". ." сюда не входят: модель не вернула бы и первую точку, которую clean_answer оставляет
+QA_STOP_SEQUENCES = ("\n\n", KEY_PHRASE)
+# Навигационный ответ - одна короткая строка
+NAV_STOP_SEQUENCES = ("\n\n",)
+NAV_MAX_TOKENS = 40
+
 PROMPT1 = """
     Ты — помощник первокурсника.
     Сейчас ты работаешь в Санкт-Петербургском Политехе.
@@ -62,23 +78,29 @@ PROMPT2 = """
 {question}
 """
 
-def qa_ai(qa_chain_a, text):
-    result = qa_chain_a.invoke({"query": text})
-    answer_a = result.get("result", "")
-    sources_a = result.get("source_documents", [])
-    key_phrase = "Информации недостаточно"
+def clean_answer(answer_a):
+    """
+    Обрезает ответ модели по правилам бота.
+    Возвращает (ответ, сработало ли правило остановки) - второе значение
+    позволяет прервать потоковую генерацию, как только ответ уже окончательно обрезан.
+    """
+    stopped = False
     
-    if answer_a.startswith(key_phrase):
-        answer_a = key_phrase
-    elif key_phrase in answer_a:
-        answer_a = answer_a.split(key_phrase, 1)[0].strip()
+    # Пустой ответ - модель остановилась на стоп-последовательности KEY_PHRASE в самом начале
+    if not answer_a.strip() or answer_a.startswith(KEY_PHRASE):
+        return KEY_PHRASE, True
+    elif KEY_PHRASE in answer_a:
+        answer_a = answer_a.split(KEY_PHRASE, 1)[0].strip()
+        stopped = True
     
     if "\n\n" in answer_a:
         answer_a = answer_a.split("\n\n", 1)[0].strip()
+        stopped = True
 
     m = re.search(r"\.\s*\.", answer_a)
     if m:
         answer_a = answer_a[:m.start() + 1].strip()
+        stopped = True
     
     pattern = r"[\.\s\n]{5,}"  # 5 или более символов из набора: точка, пробел, перенос строки
     match = re.search(pattern, answer_a)
@@ -86,7 +108,12 @@ def qa_ai(qa_chain_a, text):
         answer_a = answer_a[:match.start()].strip()
         if answer_a.endswith('.'):
             answer_a = answer_a[:-1].strip()
+        stopped = True
     
+    return answer_a, stopped
+
+
+def format_sources(sources_a):
     s = ""
     if sources_a:
         for doc in sources_a:
@@ -94,8 +121,57 @@ def qa_ai(qa_chain_a, text):
             source = meta.get("source", "Неизвестно")
             title = meta.get("title", "")
             s = s + f"- {title} ({source})\n"
+    return s
+
+
+def qa_ai(qa_chain_a, text):
+    result = qa_chain_a.invoke({"query": text})
+    answer_a = result.get("result", "")
+    sources_a = result.get("source_documents", [])
+    
+    answer_a, _ = clean_answer(answer_a)
     
-    return answer_a, s
+    return answer_a, format_sources(sources_a)
+
+
+class GenerationCancelled(Exception):
+    """Потоковая генерация прервана снаружи, ответ неполный"""
+
+
+def qa_ai_stream(qa_chain_a, text, on_update=None, should_cancel=None):
+    """
+    То же, что qa_ai, но ответ генерируется потоком: on_update(текущий_ответ)
+    вызывается на каждом фрагменте, а генерация прерывается, как только
+    сработало правило обрезки. Если should_cancel() вернул True, бросается
+    GenerationCancelled: обрывок ответа не должен попасть в кэш.
+    """
+    docs = qa_chain_a.retriever.invoke(text)
+    llm_chain = qa_chain_a.combine_documents_chain.llm_chain
+    prompt_text = llm_chain.prompt.format(
+        context="\n\n".join(doc.page_content for doc in docs),
+        question=text
+    )
+
+    raw = ""
+    stream = llm_chain.llm.stream(prompt_text)
+    try:
+        for chunk in stream:
+            raw += chunk.content
+            if not raw.strip():
+                continue
+            answer_a, stopped = clean_answer(raw)
+            if on_update:
+                on_update(answer_a)
+            if stopped:
+                break
+            if should_cancel and should_cancel():
+                raise GenerationCancelled(text)
+    finally:
+        # Закрытие потока обрывает HTTP-соединение, и Ollama перестаёт генерировать
+        stream.close()
+
+    answer_a, _ = clean_answer(raw)
+    return answer_a, format_sources(docs)
 
 def qa_ai_nav(nav_chain, text):
     """Обработка навигационных запросов"""
@@ -115,6 +191,72 @@ def qa_ai_nav(nav_chain, text):
         print(f"[ERROR] Ошибка в qa_ai_nav: {e}")
         return "Ошибка при обработке навигационного запроса"
 
+class AsyncInference:
+    """
+    Запуск синхронных цепочек LangChain из async-кода бота.
+    Генерации выполняются в отдельном пуле потоков, не блокируя event loop,
+    количество одновременных запросов ограничено, на каждый запрос есть таймаут.
+    """
+    def __init__(self, max_concurrency: int = LLM_CONCURRENCY, timeout: float = LLM_TIMEOUT):
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="llm")
+        self._semaphore = None
+        self.waiting = 0
+        self.running = 0
+        self.completed = 0
+        self.timeouts = 0
+
+    @property
+    def queue_depth(self):
+        """Количество запросов, ожидающих свободного слота"""
+        return self.waiting
+
+    def stats(self):
+        return {
+            "waiting": self.waiting,
+            "running": self.running,
+            "completed": self.completed,
+            "timeouts": self.timeouts,
+        }
+
+    async def run(self, func, *args):
+        """Выполняет func(*args) в пуле и возвращает результат или бросает asyncio.TimeoutError"""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+
+        self.running += 1
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self._executor, func, *args)
+
+        def _release(done):
+            # Слот освобождается только когда поток реально закончил работу,
+            # иначе после таймаутов в пуле скопятся "висящие" генерации
+            if not done.cancelled():
+                done.exception()  # ошибку брошенной по таймауту задачи уже никто не прочитает
+            self.running -= 1
+            self._semaphore.release()
+
+        future.add_done_callback(_release)
+
+        try:
+            result = await asyncio.wait_for(asyncio.shield(future), timeout=self.timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise
+        self.completed += 1
+        return result
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
 def init_bot(embeddings, kb_path: str = DEFAULT_KB_PATH, top_k: int = DEFAULT_TOP_K, prompt=PROMPT1):
     """Инициализация RAG-бота"""
     print(f"[INFO] Инициализация эмбеддингов и загрузка FAISS из {kb_path}...")
@@ -126,6 +268,11 @@ def init_bot(embeddings, kb_path: str = DEFAULT_KB_PATH, top_k: int = DEFAULT_TO
 
     try:
         db = FAISS.load_local(str(faiss_path), embeddings, allow_dangerous_deserialization=True)
+        # Запросы приходят нормированными, старая база могла быть собрана без нормировки.
+        # Нормированную базу отмечает model_init, такую не перебираем при каждом запуске
+        if not load_metadata(kb_path).get("normalized") and normalize_faiss_index(db):
+            print("[WARN] База собрана из ненормированных векторов; обновите её (python main.py json/pdf/url), "
+                  "чтобы она была нормирована один раз, а не при каждом запуске")
         retriever = db.as_retriever(search_kwargs={"k": top_k})
 
         prompt_template = PromptTemplate(
@@ -133,7 +280,7 @@ def init_bot(embeddings, kb_path: str = DEFAULT_KB_PATH, top_k: int = DEFAULT_TO
             template=prompt
         )
 
-        llm = get_llm()
+        llm = get_llm(stop=QA_STOP_SEQUENCES)
         qa_chain = RetrievalQA.from_chain_type(
             llm=llm,
             chain_type="stuff", 
@@ -149,8 +296,16 @@ def init_bot(embeddings, kb_path: str = DEFAULT_KB_PATH, top_k: int = DEFAULT_TO
         print(f"[ERROR] Ошибка инициализации бота: {e}")
         return None
 
-def init_bot2(prompt=PROMPT2):
-    """Инициализация навигационного бота"""
+# Готовые навигационные цепочки по ключу (prompt, модель, параметры)
+_nav_chains = {}
+
+
+def init_bot2(prompt=PROMPT2, model_name=LLM_MODEL_NAME, temperature=0.5, max_tokens=NAV_MAX_TOKENS):
+    """Инициализация навигационного бота (цепочка строится один раз на набор параметров)"""
+    key = (prompt, model_name, temperature, max_tokens)
+    if key in _nav_chains:
+        return _nav_chains[key]
+
     print(f"[INFO] Инициализация навигационного бота...")
     
     try:
@@ -159,11 +314,12 @@ def init_bot2(prompt=PROMPT2):
             template=prompt
         )
         
-        llm = get_llm()
+        llm = get_llm(model_name, temperature, max_tokens, stop=NAV_STOP_SEQUENCES)
         simple_chain = LLMChain(
             llm=llm, 
             prompt=prompt_template
         )
+        _nav_chains[key] = simple_chain
         
         print("✅ Навигационный бот запущен!")
         return simple_chain
@@ -172,6 +328,14 @@ def init_bot2(prompt=PROMPT2):
         print(f"[ERROR] Ошибка инициализации навигационного бота: {e}")
         return None
 
+def warm_up_llm(model_name=LLM_MODEL_NAME):
+    """Короткий запрос к модели при старте, чтобы Ollama заранее загрузила её в память"""
+    try:
+        get_llm(model_name).invoke("Привет", max_tokens=1)
+        print(f"[INFO] Модель {model_name} прогрета")
+    except Exception as e:
+        print(f"[WARN] Не удалось прогреть модель {model_name}: {e}")
+
 def start_rag_bot(embeddings, kb_path: str = DEFAULT_KB_PATH, top_k: int = DEFAULT_TOP_K, prompt=PROMPT1):
     """Запуск RAG-бота с подключением к FAISS"""
     
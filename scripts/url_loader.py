@@ -8,28 +8,53 @@ RAG FAISS Builder с поддержкой:
 - urls.txt с уникальными URL
 - Фильтрация URL по seed-доменам, исключение mailto/tel
 - Защита от зацикливания на 404 страницах
+- Асинхронный обход: несколько страниц параллельно, ограничение и пауза на каждый хост
 """
 
+import asyncio
+import hashlib
+import itertools
+import json
 import os
+import sqlite3
 import time
 from collections import deque
 from urllib.parse import urljoin, urlparse, urlunparse
 from pathlib import Path
 
-import requests
+import aiohttp
 from bs4 import BeautifulSoup
+try:
+    from selectolax.lexbor import LexborHTMLParser as SelectolaxParser
+except ImportError:
+    SelectolaxParser = None
+try:
+    import lxml  # noqa: F401  - нужен только как парсер для BeautifulSoup
+    BS4_PARSER = "lxml"
+except ImportError:
+    BS4_PARSER = "html.parser"
 from scripts.model_init import add_chunks_to_faiss, USER_AGENT
-from scripts.pdf_loader import extract_text_from_pdf_file
+from scripts.pdf_loader import extract_text_from_pdf_bytes, check_pdf_size, pdf_items, DOWNLOAD_CHUNK
 
 
 # ---- Настройки ----
 DEFAULT_OUT = "kb_output"
 DEFAULT_URLS_FILE = "find_urls.txt"
 DEFAULT_SEEDS_FILE = "seed_urls.txt"
+CRAWL_STATE_NAME = "crawl_state.db"
 
 CHUNK_SIZE = 500
 CHUNK_OVERLAP = 50
 MAX_CONSECUTIVE_WARNS = 5  # Максимум предупреждений подряд перед остановкой
+DEFAULT_CONCURRENCY = 8    # Сколько страниц скачивается одновременно
+DEFAULT_PER_HOST = 2       # Сколько одновременных запросов к одному хосту
+HTML_TIMEOUT = 15
+PDF_TIMEOUT = 20
+# Теги, текст которых не попадает в базу знаний
+NOISE_TAGS = ["script", "style", "noscript", "header", "footer", "nav", "aside", "form", "iframe"]
+# Разбор HTML: selectolax, если установлен, иначе BeautifulSoup (с lxml, если он есть).
+# HTML_PARSER=bs4 принудительно включает BeautifulSoup.
+HTML_BACKEND = "selectolax" if SelectolaxParser is not None and os.environ.get("HTML_PARSER") != "bs4" else "bs4"
 
 # ----- Вспомогательные функции -----
 def normalize_url(raw_url):
@@ -40,29 +65,43 @@ def normalize_url(raw_url):
     return urlunparse(parsed)
 
 
-def extract_text_from_html(html):
-    soup = BeautifulSoup(html, "html.parser")
-    for tag in soup(["script", "style", "noscript", "header", "footer", "nav", "aside", "form", "iframe"]):
-        tag.decompose()
-    main = soup.find("main") or soup.find("article") or soup.body or soup
-    text = main.get_text(separator="\n")
+def _clean_text(text):
     lines = [line.strip() for line in text.splitlines() if line.strip()]
     return " ".join(lines)
 
 
-# ----- PDF обработка -----
-def extract_text_from_pdf_url(url):
-    try:
-        resp = requests.get(url, headers={"User-Agent": USER_AGENT}, timeout=20)
-        resp.raise_for_status()
-        with open("tmp.pdf", "wb") as f:
-            f.write(resp.content)
-        text = extract_text_from_pdf_file(Path("tmp.pdf"))
-        os.remove("tmp.pdf")
-        return text
-    except Exception as e:
-        print(f"[ERROR] Failed to read PDF from URL {url}: {e}")
-        return ""
+def _parse_html_selectolax(html):
+    tree = SelectolaxParser(html)
+    title_node = tree.css_first("title")
+    title = title_node.text(strip=True) if title_node else None
+    links = [node.attributes.get("href") for node in tree.css("a[href]")]
+    tree.strip_tags(NOISE_TAGS)
+    main = tree.css_first("main") or tree.css_first("article") or tree.body or tree.root
+    text = _clean_text(main.text(separator="\n")) if main else ""
+    return text, title or None, links
+
+
+def _parse_html_bs4(html):
+    soup = BeautifulSoup(html, BS4_PARSER)
+    title = soup.title.string.strip() if soup.title and soup.title.string else None
+    # Ссылки собираем до удаления nav/header/footer: меню - основной источник ссылок для обхода
+    links = [a.get("href") for a in soup.find_all("a", href=True)]
+    for tag in soup(NOISE_TAGS):
+        tag.decompose()
+    main = soup.find("main") or soup.find("article") or soup.body or soup
+    text = _clean_text(main.get_text(separator="\n"))
+    return text, title, links
+
+
+def parse_html(html):
+    """Один разбор страницы: (текст основного содержимого, заголовок или None, ссылки)"""
+    if HTML_BACKEND == "selectolax":
+        return _parse_html_selectolax(html)
+    return _parse_html_bs4(html)
+
+
+def extract_text_from_html(html):
+    return parse_html(html)[0]
 
 
 # ----- Фильтрация URL по seed-доменам -----
@@ -83,114 +122,270 @@ def is_allowed_url(url, seed_domains):
     return False
 
 
-# ----- BFS Crawl с защитой от зацикливания на 404 -----
-def crawl(seeds, max_pages=None, delay=0.2):
+# ----- Состояние обхода между запусками -----
+class CrawlState:
+    """
+    URL -> ETag, Last-Modified, хеш тела ответа и извлечённого текста, заголовок, ссылки
+    и время скачивания. Лежит в папке базы знаний: при пересборке базы с нуля удаляется
+    вместе с ней, иначе неизменившиеся страницы не попали бы в новую базу.
+    Записи изменившихся страниц откладываются через stage() и попадают в save(),
+    только когда confirm() подтвердил, что все чанки страницы есть в FAISS.
+    """
+    COLUMNS = ("etag", "last_modified", "content_hash", "text_hash", "title", "links", "fetched_at")
+
+    def __init__(self, output_dir):
+        os.makedirs(output_dir, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(output_dir, CRAWL_STATE_NAME))
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS pages ("
+            "url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, content_hash TEXT, "
+            "title TEXT, links TEXT, fetched_at REAL, text_hash TEXT)"
+        )
+        columns = {row[1] for row in self.db.execute("PRAGMA table_info(pages)")}
+        if "text_hash" not in columns:
+            self.db.execute("ALTER TABLE pages ADD COLUMN text_hash TEXT")
+        self.records = {}
+        for url, *values in self.db.execute(f"SELECT url, {', '.join(self.COLUMNS)} FROM pages"):
+            record = dict(zip(self.COLUMNS, values))
+            record["links"] = json.loads(record["links"] or "[]")
+            self.records[url] = record
+        self.pending = {}
+        self.staged = {}
+
+    def get(self, url):
+        return self.pending.get(url) or self.records.get(url)
+
+    def update(self, url, record):
+        self.pending[url] = {**record, "fetched_at": time.time()}
+
+    def stage(self, url, record):
+        """Запись изменившейся страницы, которая ещё не попала в базу"""
+        self.staged[url] = record
+
+    def confirm(self, urls):
+        """Переносит в сохраняемые записи страницы из urls; остальные будут скачаны заново"""
+        for url in urls:
+            if url in self.staged:
+                self.update(url, self.staged.pop(url))
+
+    def save(self):
+        self.db.executemany(
+            f"INSERT OR REPLACE INTO pages (url, {', '.join(self.COLUMNS)}) "
+            f"VALUES ({', '.join('?' * (len(self.COLUMNS) + 1))})",
+            [
+                (url, *(json.dumps(r[c], ensure_ascii=False) if c == "links" else r.get(c) for c in self.COLUMNS))
+                for url, r in self.pending.items()
+            ]
+        )
+        self.db.commit()
+        self.records.update(self.pending)
+        self.pending = {}
+
+    def close(self):
+        self.db.close()
+
+
+# ----- Асинхронный BFS обход с защитой от зацикливания на 404 -----
+class HostThrottle:
+    """Пауза между началами запросов к одному хосту: вежливость считается по хосту, а не глобально"""
+    def __init__(self, delay):
+        self.delay = delay
+        self._lock = asyncio.Lock()
+        self._next_start = 0.0
+
+    async def wait(self):
+        async with self._lock:
+            loop = asyncio.get_running_loop()
+            now = loop.time()
+            if self._next_start > now:
+                await asyncio.sleep(self._next_start - now)
+                now = loop.time()
+            self._next_start = now + self.delay
+
+
+async def fetch_page(session, throttle, url, previous=None):
+    """
+    Скачивает и разбирает одну страницу, ошибки пробрасываются.
+    previous - запись CrawlState с прошлого обхода: по ней отправляется условный запрос,
+    и если страница не изменилась (304 или тот же хеш), разбор пропускается.
+    Возвращает словарь: kind ("html", "pdf" или "unchanged"), text, title, links и поля для CrawlState.
+    """
+    headers = {}
+    if previous:
+        if previous["etag"]:
+            headers["If-None-Match"] = previous["etag"]
+        if previous["last_modified"]:
+            headers["If-Modified-Since"] = previous["last_modified"]
+
+    is_pdf = url.lower().endswith(".pdf")
+    timeout = aiohttp.ClientTimeout(total=PDF_TIMEOUT if is_pdf else HTML_TIMEOUT)
+    await throttle.wait()
+    async with session.get(url, headers=headers, timeout=timeout) as resp:
+        if resp.status == 304 and previous:
+            return {**previous, "kind": "unchanged", "text": ""}
+        resp.raise_for_status()
+        if is_pdf:
+            # PDF читается потоком в память с ограничением размера: без временных файлов,
+            # поэтому параллельные загрузки друг другу не мешают
+            check_pdf_size(resp.content_length, url)
+            parts = []
+            size = 0
+            async for part in resp.content.iter_chunked(DOWNLOAD_CHUNK):
+                parts.append(part)
+                size += len(part)
+                check_pdf_size(size, url)
+            body = b"".join(parts)
+        else:
+            body = await resp.read()
+        try:
+            encoding = resp.get_encoding()
+        except Exception:
+            encoding = "utf-8"
+        record = {
+            "etag": resp.headers.get("ETag"),
+            "last_modified": resp.headers.get("Last-Modified"),
+            "content_hash": hashlib.sha1(body).hexdigest(),
+        }
+
+    if previous and previous["content_hash"] == record["content_hash"]:
+        return {**previous, **record, "kind": "unchanged", "text": ""}
+
+    # Разбор PDF и HTML нагружает процессор - уводим его из event loop
+    if is_pdf:
+        text = await asyncio.to_thread(extract_text_from_pdf_bytes, body, url)
+        result = {**record, "kind": "pdf", "text": text, "title": url, "links": []}
+    else:
+        text, title, links = await asyncio.to_thread(parse_html, body.decode(encoding, errors="replace"))
+        result = {**record, "kind": "html", "text": text, "title": title or url, "links": links}
+
+    # Тело могло измениться только в служебной части (токены, счётчики, время) - текст тот же
+    result["text_hash"] = hashlib.sha1(text.encode("utf-8")).hexdigest()
+    if previous and previous.get("text_hash") == result["text_hash"]:
+        return {**result, "kind": "unchanged", "text": ""}
+    return result
+
+
+async def crawl_async(seeds, max_pages=None, delay=0.2, concurrency=DEFAULT_CONCURRENCY, per_host=DEFAULT_PER_HOST,
+                      state=None):
     seed_domains = seeds
     queue = deque(normalize_url(s) for s in seeds)
     seen = set()
     ordered_urls = []
     pages = {}
+    unchanged = 0
     page_counter = 0
-    consecutive_warns = 0  # Счетчик последовательных предупреждений
-    
+    consecutive_warns = 0  # Счетчик последовательных предупреждений (в порядке завершения запросов)
+    throttles = {}
+    in_flight = {}
+
     # Словарь для отслеживания глубины URL (сколько раз поднимались)
     url_depths = {}
     for seed in seeds:
         url_depths[normalize_url(seed)] = 0
 
-    while queue:
-        url = queue.popleft()
-        url_norm = normalize_url(url)
-        if url_norm in seen:
-            continue
-        seen.add(url_norm)
-        page_counter += 1
-
-        # Получаем текущую глубину URL или устанавливаем по умолчанию
-        current_depth = url_depths.get(url_norm, 0)
-
-        if url_norm.lower().endswith(".pdf"):
-            text = extract_text_from_pdf_url(url_norm)
-            pages[url_norm] = {"text": text, "title": url_norm}
-            ordered_urls.append(url_norm)
-            print(f"[{page_counter}] [PDF] {url_norm} (text len: {len(text)})")
-            consecutive_warns = 0  # Сбрасываем счетчик при успешной обработке
-            if max_pages and len(ordered_urls) >= max_pages:
+    def limit_reached(extra=0):
+        return bool(max_pages) and len(ordered_urls) + extra >= max_pages
+
+    def record_failure(url_norm, n, e):
+        print(f"[{n}] [WARN] Failed {url_norm}: {e}")
+        pages[url_norm] = {"text": "", "title": ""}
+        ordered_urls.append(url_norm)
+
+    # keep-alive: одна сессия и пул соединений на весь обход
+    connector = aiohttp.TCPConnector(limit=concurrency, limit_per_host=per_host)
+    async with aiohttp.ClientSession(connector=connector, headers={"User-Agent": USER_AGENT}) as session:
+        while queue or in_flight:
+            while queue and len(in_flight) < concurrency and not limit_reached(len(in_flight)):
+                url_norm = normalize_url(queue.popleft())
+                if url_norm in seen:
+                    continue
+                seen.add(url_norm)
+                page_counter += 1
+                host = urlparse(url_norm).netloc
+                throttle = throttles.setdefault(host, HostThrottle(delay))
+                previous = state.get(url_norm) if state is not None else None
+                task = asyncio.create_task(fetch_page(session, throttle, url_norm, previous))
+                in_flight[task] = (url_norm, page_counter)
+
+            if not in_flight:
                 break
-            continue
+            done, _ = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
 
-        try:
-            r = requests.get(url_norm, headers={"User-Agent": USER_AGENT}, timeout=15)
-            r.raise_for_status()
-            html = r.text
-            text = extract_text_from_html(html)
-            soup = BeautifulSoup(html, "html.parser")
-            title = soup.title.string.strip() if soup.title and soup.title.string else url_norm
-            pages[url_norm] = {"text": text, "title": title}
-            ordered_urls.append(url_norm)
-            print(f"[{page_counter}] [HTML] {url_norm} (text len: {len(text)})")
-            consecutive_warns = 0  # Сбрасываем счетчик при успешной обработке
-
-            # BFS ссылки с учетом текущей глубины
-            for a in soup.find_all("a", href=True):
-                href = a.get("href")
+            for task in done:
+                url_norm, n = in_flight.pop(task)
+                if limit_reached():
+                    continue
+                # Получаем текущую глубину URL или устанавливаем по умолчанию
+                current_depth = url_depths.get(url_norm, 0)
                 try:
-                    joined = urljoin(url_norm, href)
-                    norm = normalize_url(joined)
+                    result = task.result()
+                except aiohttp.ClientResponseError as e:
+                    record_failure(url_norm, n, e)
+                    consecutive_warns += 1
+                    if e.status == 404 and consecutive_warns >= MAX_CONSECUTIVE_WARNS:
+                        print(f"[WARN] Достигнуто {MAX_CONSECUTIVE_WARNS} предупреждений подряд. Поднимаемся на уровень выше...")
+
+                        # Поднимаемся на уровень выше - ищем родительский URL
+                        parent_url = get_parent_url(url_norm)
+                        if parent_url and parent_url not in seen:
+                            print(f"[INFO] Добавляем родительский URL в очередь: {parent_url}")
+                            queue.appendleft(parent_url)  # Добавляем в начало очереди
+                            url_depths[parent_url] = current_depth + 1
+
+                        consecutive_warns = 0  # Сбрасываем счетчик после подъема
+                    continue
+                except Exception as e:
+                    record_failure(url_norm, n, str(e) or type(e).__name__)
+                    consecutive_warns += 1
+                    continue
+
+                consecutive_warns = 0  # Сбрасываем счетчик при успешной обработке
+                ordered_urls.append(url_norm)
+                record = {k: result.get(k) for k in CrawlState.COLUMNS if k != "fetched_at"}
+                if result["kind"] == "unchanged":
+                    # Текст страницы уже в базе: не извлекаем и не режем на чанки, только идём по ссылкам
+                    unchanged += 1
+                    if state is not None:
+                        state.update(url_norm, record)
+                    print(f"[{n}] [SAME] {url_norm}")
+                else:
+                    if state is not None:
+                        state.stage(url_norm, record)
+                    pages[url_norm] = {"text": result["text"], "title": result["title"]}
+                    print(f"[{n}] [{result['kind'].upper()}] {url_norm} (text len: {len(result['text'])})")
+
+                # BFS ссылки с учетом текущей глубины
+                for href in result["links"]:
+                    try:
+                        norm = normalize_url(urljoin(url_norm, href))
+                    except Exception:
+                        continue
                     if norm not in seen and is_allowed_url(norm, seed_domains):
                         # Сохраняем глубину для нового URL
                         url_depths[norm] = current_depth
                         queue.append(norm)
-                except Exception:
-                    continue
 
-        except requests.exceptions.HTTPError as e:
-            if e.response.status_code == 404:
-                print(f"[{page_counter}] [WARN] Failed {url_norm}: {e}")
-                pages[url_norm] = {"text": "", "title": ""}
-                ordered_urls.append(url_norm)
-                consecutive_warns += 1
-                
-                # Проверяем, не достигли ли лимита предупреждений
-                if consecutive_warns >= MAX_CONSECUTIVE_WARNS:
-                    print(f"[WARN] Достигнуто {MAX_CONSECUTIVE_WARNS} предупреждений подряд. Поднимаемся на уровень выше...")
-                    
-                    # Поднимаемся на уровень выше - ищем родительский URL
-                    parent_url = get_parent_url(url_norm)
-                    if parent_url and parent_url not in seen:
-                        print(f"[INFO] Добавляем родительский URL в очередь: {parent_url}")
-                        queue.appendleft(parent_url)  # Добавляем в начало очереди
-                        url_depths[parent_url] = current_depth + 1
-                    
-                    consecutive_warns = 0  # Сбрасываем счетчик после подъема
-                    
-            else:
-                # Для других HTTP ошибок просто логируем
-                print(f"[{page_counter}] [WARN] Failed {url_norm}: {e}")
-                pages[url_norm] = {"text": "", "title": ""}
-                ordered_urls.append(url_norm)
-                consecutive_warns += 1
-                
-        except Exception as e:
-            print(f"[{page_counter}] [WARN] Failed {url_norm}: {e}")
-            pages[url_norm] = {"text": "", "title": ""}
-            ordered_urls.append(url_norm)
-            consecutive_warns += 1
-
-        # Проверяем общий лимит предупреждений для не-404 ошибок
-        if consecutive_warns >= MAX_CONSECUTIVE_WARNS:
-            print(f"[WARN] Достигнуто {MAX_CONSECUTIVE_WARNS} ошибок подряд. Пропускаем следующие URL...")
-            # Пропускаем следующие URL до тех пор, пока не найдем рабочий
-            # Это предотвращает зацикливание на битых ссылках
-            
-        if max_pages and len(ordered_urls) >= max_pages:
-            print(f"[INFO] Reached max_pages={max_pages}. Stopping crawl.")
-            break
-        time.sleep(delay)
-    
+            if limit_reached():
+                print(f"[INFO] Reached max_pages={max_pages}. Stopping crawl.")
+                for task in in_flight:
+                    task.cancel()
+                await asyncio.gather(*in_flight, return_exceptions=True)
+                break
+
+    if state is not None:
+        print(f"[INFO] Не изменились с прошлого обхода: {unchanged} страниц")
     return ordered_urls, pages
 
 
+def crawl(seeds, max_pages=None, delay=0.2, concurrency=DEFAULT_CONCURRENCY, per_host=DEFAULT_PER_HOST, state=None):
+    """
+    Обход seed URL в ширину. Возвращает (список URL в порядке обработки, {url: {"text", "title"}}).
+    delay - пауза между запросами к одному хосту; concurrency=1, per_host=1 дают последовательный обход.
+    С state (CrawlState) страницы, не изменившиеся с прошлого обхода, есть только в списке URL.
+    """
+    return asyncio.run(crawl_async(seeds, max_pages, delay, concurrency, per_host, state))
+
+
 def get_parent_url(url):
     """
     Возвращает родительский URL на один уровень выше.
@@ -230,7 +425,8 @@ def get_parent_url(url):
         return None
 
 
-def crawl_and_update_faiss(embedder, seeds_file: str, output_dir: str, max_pages: int = 100, delay: float = 0.2, pdf_path: str = None):
+def crawl_and_update_faiss(embedder, seeds_file: str, output_dir: str, max_pages: int = 100, delay: float = 0.2, pdf_path: str = None,
+                           concurrency: int = DEFAULT_CONCURRENCY, per_host: int = DEFAULT_PER_HOST):
     """
     Главная функция для обработки seed URL, обхода HTML и PDF ссылок, обновления FAISS.
     """
@@ -242,29 +438,33 @@ def crawl_and_update_faiss(embedder, seeds_file: str, output_dir: str, max_pages
 
     print(f"[START] {len(seeds)} seeds loaded.")
 
-    # Обход URL
-    ordered_urls, pages = crawl(seeds, max_pages=max_pages, delay=delay)
+    # Обход URL: условные запросы по состоянию прошлого обхода
+    state = CrawlState(output_dir)
+    ordered_urls, pages = crawl(seeds, max_pages=max_pages, delay=delay, concurrency=concurrency, per_host=per_host,
+                                state=state)
 
-    # Добавляем локальные PDF, если есть
-    pdf_items = {}
+    # Добавляем локальные PDF, если есть: разбираются в пуле процессов и сразу идут на чанки
+    pdf_sources = []
+    all_items = pages.items()
     if pdf_path:
-        pdf_dir = Path(pdf_path)
-        for f in pdf_dir.rglob("*.pdf"):
-            text = extract_text_from_pdf_file(f)
-            if text.strip():
-                pdf_items[str(f.resolve())] = {"text": text, "title": f.stem}
-
-
-    all_items = {**pages, **pdf_items}
+        pdf_paths = sorted(Path(pdf_path).rglob("*.pdf"))
+        all_items = itertools.chain(all_items, pdf_items(pdf_paths, found=pdf_sources))
 
     # Обновление FAISS
-    add_chunks_to_faiss(all_items, output_dir, embedder)
+    indexed = set()
+    add_chunks_to_faiss(all_items, output_dir, embedder, indexed_sources=indexed)
+
+    # Состояние сохраняем только для страниц, все чанки которых попали в базу,
+    # иначе в следующий раз они были бы пропущены как неизменные
+    state.confirm(indexed)
+    if state.staged:
+        print(f"[WARN] {len(state.staged)} страниц не попали в базу целиком и будут обработаны при следующем обходе")
+    state.save()
+    state.close()
 
     # Обновление urls.txt
     urls_txt_path = Path(output_dir) / "find_urls.txt"
-    all_urls = list(pages.keys())
-    if pdf_items:
-        all_urls += list(pdf_items.keys())
+    all_urls = list(ordered_urls) + pdf_sources
     os.makedirs(output_dir, exist_ok=True)
     with open(urls_txt_path, "w", encoding="utf-8") as f:
         for u in all_urls:
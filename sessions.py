@@ -0,0 +1,158 @@
+import logging
+import sqlite3
+import time
+from collections import OrderedDict
+
+import aiosqlite
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TTL = 6 * 3600       # режим сбрасывается после 6 часов бездействия
+DEFAULT_MAX_SESSIONS = 50000
+PURGE_INTERVAL = 1000        # раз в сколько записей чистить просроченные сессии в SQLite
+# Сколько ждать блокировку SQLite. Запросы идут через aiosqlite в отдельном потоке,
+# поэтому ожидание не останавливает event loop
+DB_TIMEOUT = 5.0
+
+
+class SessionStore:
+    """
+    Режимы чатов (свободный вопрос, навигация) с ограниченным временем жизни.
+    Без db_path хранит всё в памяти процесса (LRU не больше max_sessions записей),
+    с db_path - в SQLite, чтобы режимы переживали перезапуск и были общими
+    для нескольких процессов бота. SQLite работает через aiosqlite, как ReminderManager.
+    Если база так и не освободилась за DB_TIMEOUT, чтение считается промахом,
+    а set() возвращает False - вызывающий код должен сообщить об этом пользователю.
+    Значение None означает "нет режима" и не хранится вовсе.
+    """
+    def __init__(self, db_path=None, ttl=DEFAULT_TTL, max_sessions=DEFAULT_MAX_SESSIONS):
+        self.db_path = db_path
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self._memory = OrderedDict()
+        self._writes = 0
+        self.expired = 0
+        self.evicted = 0
+        self.db = None
+
+    async def _get_db(self):
+        if self.db is None:
+            db = await aiosqlite.connect(self.db_path, timeout=DB_TIMEOUT, isolation_level=None)
+            try:
+                await db.execute("PRAGMA journal_mode=WAL")
+                await db.execute("PRAGMA synchronous=NORMAL")
+                await db.execute(
+                    "CREATE TABLE IF NOT EXISTS sessions ("
+                    "chat_id INTEGER PRIMARY KEY, mode TEXT NOT NULL, updated_at REAL NOT NULL)"
+                )
+            except sqlite3.OperationalError:
+                # Соединение без таблицы не сохраняем: следующий вызов попробует снова
+                await db.close()
+                raise
+            self.db = db
+            logger.info(f"Сессии хранятся в SQLite: {self.db_path}")
+        return self.db
+
+    async def get(self, chat_id, default=None):
+        now = time.time()
+        if self.db_path:
+            try:
+                return await self._db_get(chat_id, default, now)
+            except sqlite3.OperationalError as e:
+                logger.warning(f"Сессия {chat_id} не прочитана: {e}")
+                return default
+
+        entry = self._memory.get(chat_id)
+        if entry is None:
+            return default
+        mode, updated_at = entry
+        if now - updated_at >= self.ttl:
+            del self._memory[chat_id]
+            self.expired += 1
+            return default
+        self._memory[chat_id] = (mode, now)
+        self._memory.move_to_end(chat_id)
+        return mode
+
+    async def set(self, chat_id, mode):
+        """Сохраняет режим чата. Возвращает False, если записать не удалось"""
+        now = time.time()
+        if self.db_path:
+            try:
+                await self._db_set(chat_id, mode, now)
+            except sqlite3.OperationalError as e:
+                logger.warning(f"Сессия {chat_id} не сохранена: {e}")
+                return False
+            return True
+
+        if mode is None:
+            self._memory.pop(chat_id, None)
+            return True
+        self._memory[chat_id] = (mode, now)
+        self._memory.move_to_end(chat_id)
+        while len(self._memory) > self.max_sessions:
+            self._memory.popitem(last=False)
+            self.evicted += 1
+        return True
+
+    async def _db_get(self, chat_id, default, now):
+        db = await self._get_db()
+        async with db.execute("SELECT mode, updated_at FROM sessions WHERE chat_id = ?", (chat_id,)) as cursor:
+            row = await cursor.fetchone()
+        if row is None:
+            return default
+        mode, updated_at = row
+        if now - updated_at >= self.ttl:
+            await db.execute("DELETE FROM sessions WHERE chat_id = ?", (chat_id,))
+            self.expired += 1
+            return default
+        # Продлеваем сессию не на каждом сообщении, а когда прошла половина TTL
+        if now - updated_at > self.ttl / 2:
+            await db.execute("UPDATE sessions SET updated_at = ? WHERE chat_id = ?", (now, chat_id))
+        return mode
+
+    async def _db_set(self, chat_id, mode, now):
+        db = await self._get_db()
+        if mode is None:
+            # Сброс режима идёт на каждое нажатие кнопки: чтение в WAL не берёт блокировку записи,
+            # поэтому удаляем, только если сессия действительно есть
+            async with db.execute("SELECT 1 FROM sessions WHERE chat_id = ?", (chat_id,)) as cursor:
+                exists = await cursor.fetchone()
+            if exists:
+                await db.execute("DELETE FROM sessions WHERE chat_id = ?", (chat_id,))
+            return
+        await db.execute(
+            "INSERT INTO sessions (chat_id, mode, updated_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(chat_id) DO UPDATE SET mode = excluded.mode, updated_at = excluded.updated_at",
+            (chat_id, mode, now)
+        )
+        self._writes += 1
+        if self._writes % PURGE_INTERVAL == 0:
+            await self._purge_db(db, now)
+
+    async def _purge_db(self, db, now):
+        cursor = await db.execute("DELETE FROM sessions WHERE updated_at < ?", (now - self.ttl,))
+        self.expired += cursor.rowcount
+        cursor = await db.execute(
+            "DELETE FROM sessions WHERE chat_id NOT IN "
+            "(SELECT chat_id FROM sessions ORDER BY updated_at DESC LIMIT ?)",
+            (self.max_sessions,)
+        )
+        self.evicted += cursor.rowcount
+
+    async def stats(self):
+        if self.db_path:
+            db = await self._get_db()
+            async with db.execute(
+                "SELECT COUNT(*) FROM sessions WHERE updated_at >= ?", (time.time() - self.ttl,)
+            ) as cursor:
+                live = (await cursor.fetchone())[0]
+        else:
+            now = time.time()
+            live = sum(1 for _, updated_at in self._memory.values() if now - updated_at < self.ttl)
+        return {"live": live, "expired": self.expired, "evicted": self.evicted}
+
+    async def close(self):
+        if self.db is not None:
+            await self.db.close()
+            self.db = None
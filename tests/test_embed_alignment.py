@@ -0,0 +1,79 @@
+import hashlib
+import random
+import threading
+
+import numpy as np
+
+from scripts.model_init import add_chunks_to_faiss, embed_in_batches
+
+DIMENSION = 8
+
+
+def text_vector(text):
+    """Вектор однозначно определяется текстом: по нему видно, к какому тексту он относится"""
+    digest = hashlib.sha1(text.encode("utf-8")).digest()
+    return [b / 255 for b in digest[:DIMENSION]]
+
+
+class FlakyEmbedder:
+    """Падает, теряет векторы и возвращает пачки неверной длины в случайные моменты"""
+    model_name = "flaky-test"
+
+    def __init__(self, seed=0, failure_rate=0.3):
+        self.random = random.Random(seed)
+        self.failure_rate = failure_rate
+        self.lock = threading.Lock()
+
+    def _roll(self):
+        with self.lock:
+            return self.random.random()
+
+    def embed_documents(self, texts):
+        roll = self._roll()
+        if roll < self.failure_rate / 3:
+            raise ConnectionError("ollama unavailable")
+        if roll < self.failure_rate * 2 / 3:
+            return [text_vector(t) for t in texts[:-1]]
+        return [None if self._roll() < self.failure_rate / 3 else text_vector(t) for t in texts]
+
+    def embed_query(self, text):
+        return text_vector(text)
+
+    def __call__(self, text):
+        return self.embed_query(text)
+
+
+def test_embed_in_batches_keeps_alignment():
+    texts = [f"фрагмент {i} " * (i % 7 + 1) for i in range(5000)]
+    embeddings, report = embed_in_batches(texts, FlakyEmbedder(), batch_size=37, workers=8,
+                                          retries=1, retry_delay=0)
+
+    assert len(embeddings) == len(texts)
+    for text, embedding in zip(texts, embeddings):
+        assert embedding is None or embedding == text_vector(text)
+    assert report["embedded"] + report["failed"] == len(texts)
+    assert report["failed"] == sum(e is None for e in embeddings)
+    assert report["embedded"] > 0 and report["failed"] > 0
+
+
+def test_faiss_vectors_match_their_chunks(tmp_path):
+    items = {
+        f"source-{i}": {"text": f"Источник {i}. " + " ".join(f"слово{i}_{k}" for k in range(60)), "title": f"T{i}"}
+        for i in range(1000)
+    }
+    indexed = set()
+    db = add_chunks_to_faiss(items, str(tmp_path), FlakyEmbedder(seed=1), batch_size=16, workers=8,
+                             cache_path=None, indexed_sources=indexed)
+
+    assert db is not None
+    vectors = db.index.reconstruct_n(0, db.index.ntotal)
+    for position, doc_id in db.index_to_docstore_id.items():
+        doc = db.docstore.search(doc_id)
+        assert np.allclose(vectors[position], text_vector(doc.page_content), atol=1e-6)
+        assert doc.metadata["text"] == doc.page_content
+        assert doc.page_content in items[doc.metadata["source"]]["text"]
+
+    in_base = {db.docstore.search(doc_id).metadata["source"] for doc_id in db.index_to_docstore_id.values()}
+    assert indexed <= in_base
+    assert len(indexed) < len(items)
+    assert (tmp_path / "faiss_index" / "index.faiss").exists()
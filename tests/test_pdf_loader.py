@@ -0,0 +1,25 @@
+import time
+
+import scripts.pdf_loader as pdf_loader
+
+
+def _fake_pdf_task(path, start=0, stop=None):
+    """a.pdf разбирается сразу, big.pdf делится на 4 части, первые взятые в работу две зависают"""
+    if path.endswith("big.pdf"):
+        if stop is None:
+            return "split", 4 * pdf_loader.PAGES_PER_TASK
+        if start >= 2 * pdf_loader.PAGES_PER_TASK:
+            time.sleep(30)
+        return "text", f"big {start}"
+    return "text", f"text of {path}"
+
+
+def test_timed_out_part_skips_whole_file(monkeypatch, tmp_path):
+    monkeypatch.setattr(pdf_loader, "_pdf_task", _fake_pdf_task)
+    paths = [tmp_path / "a.pdf", tmp_path / "big.pdf"]
+
+    started = time.monotonic()
+    results = dict(pdf_loader.iter_pdf_texts(paths, workers=2, timeout=1))
+
+    assert results == {paths[0]: f"text of {paths[0]}"}
+    assert time.monotonic() - started < 10